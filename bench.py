@@ -0,0 +1,352 @@
+"""Load-test the bot's pipeline against a fake Telegram client and a fake aria2 daemon.
+
+Simulated users send magnet links through message_handler; the real scheduler, progress
+updater, ordered uploader and job journal do the rest. Nothing leaves the machine.
+
+    python bench.py --users 20 --jobs-per-user 3 --files 4 --file-size-mb 64
+"""
+import os
+import sys
+import time
+import json
+import random
+import secrets
+import asyncio
+import argparse
+import tempfile
+import shutil
+
+import psutil
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--jobs-per-user", type=int, default=2)
+    parser.add_argument("--files", type=int, default=4, help="files per torrent")
+    parser.add_argument("--file-size-mb", type=float, default=32)
+    parser.add_argument("--download-mbps", type=float, default=200, help="per-torrent download speed, MB/s")
+    parser.add_argument("--upload-mbps", type=float, default=400, help="per-upload speed, MB/s")
+    parser.add_argument("--metadata-delay", type=float, default=0.5, help="seconds to resolve a magnet")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds per Telegram API call")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="chance an API call raises FloodWait")
+    parser.add_argument("--flood-wait", type=int, default=2, help="FloodWait value in seconds")
+    parser.add_argument("--poll-interval", type=float, default=None, help="override ARIA2_POLL_INTERVAL")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+args = parse_args()
+workdir = tempfile.mkdtemp(prefix="torrentbot-bench-")
+os.environ.update(API_ID="1", API_HASH="bench", BOT_TOKEN="0:bench", ROLE="all", FILE_PICKER="0",
+                  DOWNLOAD_DIR=os.path.join(workdir, "downloads"), STATE_DIR=os.path.join(workdir, "state"),
+                  HEALTH_PORT="0")
+os.environ.setdefault("MIN_FREE_DISK_MB", "0")
+os.environ.setdefault("MAX_QUEUED_PER_USER", str(args.jobs_per_user))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+
+MB = 1024 * 1024
+counters = {"edits": 0, "sends": 0, "uploads": 0, "uploaded_bytes": 0, "floodwaits": 0}
+
+
+async def api_call():
+    """Simulate one Telegram round trip, occasionally answering with FloodWait."""
+    await asyncio.sleep(args.api_latency)
+    if args.flood_rate and random.random() < args.flood_rate:
+        counters["floodwaits"] += 1
+        raise FloodWait(value=args.flood_wait)
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeMessage:
+    """The parts of pyrogram's Message the bot uses, for both incoming links and status messages."""
+    next_id = 1
+
+    def __init__(self, user_id, text=None):
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+        self.chat = FakeChat(user_id)
+        self.from_user = FakeChat(user_id)
+        self.text = text
+        self.document = None
+
+    async def edit_text(self, text, reply_markup=None):
+        await api_call()
+        counters["edits"] += 1
+
+    async def reply(self, text):
+        await api_call()
+        counters["sends"] += 1
+
+    async def delete(self):
+        await api_call()
+
+
+async def send_message(chat_id, text, **kwargs):
+    await api_call()
+    counters["sends"] += 1
+    return FakeMessage(chat_id)
+
+
+async def save_file(path, progress=None, progress_args=()):
+    """Read the part the way pyrogram does, pacing it at the simulated uplink speed."""
+    # The real method runs under this semaphore, which caps uploads in flight
+    async with main.bot.save_file_semaphore:
+        part_size = 512 * 1024
+        fp = open(path, "rb") if isinstance(path, str) else path
+        try:
+            fp.seek(0, os.SEEK_END)
+            size = fp.tell()
+            fp.seek(0)
+            sent = 0
+            while True:
+                chunk = fp.read(part_size)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                await asyncio.sleep(len(chunk) / (args.upload_mbps * MB))
+                if progress:
+                    await progress(sent, size, *progress_args)
+        finally:
+            if isinstance(path, str):
+                fp.close()
+        counters["uploaded_bytes"] += size
+        return raw.types.InputFile(id=secrets.randbits(63), parts=max(1, size // part_size), name="bench", md5_checksum="")
+
+
+async def invoke(rpc):
+    await api_call()
+    counters["uploads"] += 1
+    return raw.types.Updates(updates=[], users=[], chats=[], date=int(time.time()), seq=0)
+
+
+async def resolve_peer(chat_id):
+    return raw.types.InputPeerUser(user_id=chat_id, access_hash=0)
+
+
+class FakeAria2:
+    """Answers the RPC calls main.py makes, downloading synthetic files at a fixed speed.
+
+    Magnets resolve after --metadata-delay into a new GID (followedBy), as with the real daemon.
+    Finished files are allocated on disk so cleanup and disk-budget paths see real usage.
+    """
+
+    def __init__(self):
+        self.downloads = {}
+
+    def add(self, link, options):
+        gid = secrets.token_hex(8)
+        files = [os.path.join(options["dir"], f"part{i:02d}.bin") for i in range(1, args.files + 1)]
+        selected = {int(i) for i in options["select-file"].split(",")} if "select-file" in options else None
+        self.downloads[gid] = {
+            "files": files, "selected": selected, "written": set(),
+            "paused": options.get("pause") == "true", "started": None,
+            "metadata_until": time.monotonic() + args.metadata_delay if link.startswith("magnet:?") else None,
+            "hold": options.get("pause-metadata") == "true", "followed_by": None,
+            "infohash": main.magnet_infohash(link) or secrets.token_hex(20),
+        }
+        if not self.downloads[gid]["paused"] and self.downloads[gid]["metadata_until"] is None:
+            self.downloads[gid]["started"] = time.monotonic()
+        return gid
+
+    def wanted(self, d):
+        return [i for i in range(1, len(d["files"]) + 1) if d["selected"] is None or i in d["selected"]]
+
+    def progress(self, d):
+        """Bytes done per selected file, filling the files one after another."""
+        size = int(args.file_size_mb * MB)
+        done = (time.monotonic() - d["started"]) * args.download_mbps * MB if d["started"] else 0
+        per_file = {}
+        for index in self.wanted(d):
+            per_file[index] = int(min(size, max(0, done)))
+            done -= size
+        return per_file
+
+    def tell_status(self, gid, keys=None):
+        d = self.downloads[gid]
+        if d["metadata_until"] is not None:
+            if time.monotonic() < d["metadata_until"]:
+                return {"status": "active", "totalLength": "0", "completedLength": "0", "downloadSpeed": "0",
+                        "infoHash": d["infohash"], "files": [{"index": "1", "path": "[METADATA]x", "length": "0",
+                                                              "completedLength": "0", "selected": "true"}]}
+            if d["followed_by"] is None:
+                content = self.add("bench.torrent", {"dir": os.path.dirname(d["files"][0]),
+                                                     "pause": "true" if d["hold"] else "false"})
+                self.downloads[content]["infohash"] = d["infohash"]
+                d["followed_by"] = content
+            return {"status": "complete", "followedBy": [d["followed_by"]], "infoHash": d["infohash"]}
+
+        size = int(args.file_size_mb * MB)
+        per_file = self.progress(d)
+        files = []
+        for index, path in enumerate(d["files"], 1):
+            done = per_file.get(index, 0)
+            if done == size and index not in d["written"]:
+                with open(path, "wb") as f:
+                    if hasattr(os, "posix_fallocate"):
+                        os.posix_fallocate(f.fileno(), 0, size)
+                    else:
+                        f.truncate(size)
+                d["written"].add(index)
+            files.append({"index": str(index), "path": path, "length": str(size),
+                          "completedLength": str(done), "selected": "true" if index in per_file else "false"})
+        total = size * len(per_file)
+        completed = sum(per_file.values())
+        status = "paused" if d["paused"] else "complete" if completed == total else "active"
+        speed = 0 if status != "active" else int(args.download_mbps * MB)
+        return {"status": status, "totalLength": str(total), "completedLength": str(completed),
+                "downloadSpeed": str(speed), "infoHash": d["infohash"], "files": files}
+
+    def call(self, method, *params):
+        if method == "tell_status":
+            return self.tell_status(*params)
+        if method == "get_files":
+            return self.tell_status(params[0])["files"]
+        if method == "change_option":
+            gid, options = params
+            if "select-file" in options:
+                self.downloads[gid]["selected"] = {int(i) for i in options["select-file"].split(",")}
+            return "OK"
+        if method == "unpause":
+            d = self.downloads[params[0]]
+            if d["paused"]:
+                d["paused"] = False
+                d["started"] = time.monotonic()
+            return params[0]
+        if method in ("force_remove", "remove_download_result"):
+            self.downloads.get(params[0], {}).update(paused=True)
+            return "OK"
+        if method == "get_global_stat":
+            active = [d for d in self.downloads.values() if d["started"] and not d["paused"]]
+            return {"downloadSpeed": str(int(len(active) * args.download_mbps * MB))}
+        raise NotImplementedError(method)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def directory_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+async def sample_host(peaks, stop):
+    process = psutil.Process()
+    while not stop.is_set():
+        peaks["rss"] = max(peaks["rss"], process.memory_info().rss)
+        peaks["disk"] = max(peaks["disk"], await asyncio.to_thread(directory_usage, main.DOWNLOAD_DIR))
+        await asyncio.sleep(0.2)
+
+
+async def sample_loop_lag(lags, stop):
+    """Finer-grained than main.loop_lag_monitor, so short stalls show up in the percentiles."""
+    while not stop.is_set():
+        started = time.monotonic()
+        await asyncio.sleep(0.05)
+        lags.append(max(0.0, time.monotonic() - started - 0.05))
+
+
+async def run():
+    aria2 = FakeAria2()
+
+    async def fake_aria2_call(method, *params):
+        return aria2.call(method, *params)
+
+    async def fake_add_download(link, options):
+        return aria2.add(link, options)
+
+    main.aria2_call = fake_aria2_call
+    main.add_aria2_download = fake_add_download
+    main.bot.send_message = send_message
+    main.bot.save_file = save_file
+    main.bot.invoke = invoke
+    main.bot.resolve_peer = resolve_peer
+    main.bot.rnd_id = lambda: secrets.randbits(63)
+    if args.poll_interval is not None:
+        main.ARIA2_POLL_INTERVAL = args.poll_interval
+
+    submitted, finished = {}, {}
+    process_job = main.process_job
+
+    async def timed_process_job(user_id, job_id, link):
+        try:
+            return await process_job(user_id, job_id, link)
+        finally:
+            finished[link] = time.monotonic()
+
+    main.process_job = timed_process_job
+    os.makedirs(main.DOWNLOAD_DIR, exist_ok=True)
+
+    stop = asyncio.Event()
+    peaks = {"rss": 0, "disk": 0}
+    lags = []
+    background = [
+        asyncio.create_task(main.download_scheduler()),
+        asyncio.create_task(main.progress_updater()),
+        asyncio.create_task(sample_host(peaks, stop)),
+        asyncio.create_task(sample_loop_lag(lags, stop)),
+    ]
+
+    started = time.monotonic()
+    for _ in range(args.jobs_per_user):
+        for user_id in range(1, args.users + 1):
+            link = f"magnet:?xt=urn:btih:{secrets.token_hex(20)}&dn=bench-{user_id}"
+            submitted[link] = time.monotonic()
+            await main.message_handler(main.bot, FakeMessage(user_id, link))
+
+    while len(finished) < len(submitted):
+        await asyncio.sleep(0.1)
+    elapsed = time.monotonic() - started
+    stop.set()
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    latencies = [finished[link] - submitted[link] for link in submitted]
+    failed = main.get_jobs_db().execute("SELECT COUNT(*) FROM jobs WHERE state = 'failed'").fetchone()[0]
+    return {
+        "jobs": len(submitted),
+        "failed": failed,
+        "elapsed_s": round(elapsed, 2),
+        "jobs_per_min": round(len(submitted) / elapsed * 60, 2),
+        "latency_p50_s": round(percentile(latencies, 0.5), 2),
+        "latency_p99_s": round(percentile(latencies, 0.99), 2),
+        "loop_lag_p99_ms": round(percentile(lags, 0.99) * 1000, 2),
+        "loop_lag_max_ms": round(max(lags, default=0) * 1000, 2),
+        "edits_per_s": round(counters["edits"] / elapsed, 2),
+        "uploads": counters["uploads"],
+        "upload_mb_per_s": round(counters["uploaded_bytes"] / MB / elapsed, 2),
+        "floodwaits": counters["floodwaits"],
+        "peak_rss_mb": round(peaks["rss"] / MB, 1),
+        "peak_disk_mb": round(peaks["disk"] / MB, 1),
+    }
+
+
+if __name__ == "__main__":
+    try:
+        report = asyncio.run(run())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for key, value in report.items():
+            print(f"{key:>18}: {value}")
@@ -1,4 +1,5 @@
 import os
+import io
 import time
 import shutil
 import mimetypes
@@ -9,15 +10,29 @@ import requests
 import psutil
 import subprocess
 import math
-from threading import Thread
-from collections import deque
+import functools
+import json
+import sqlite3
+import base64
+import secrets
+import struct
+import tarfile
+import bisect
+import hashlib
+import aria2p
+from threading import Thread, Lock
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from shlex import quote
 from urllib.parse import urlparse, unquote, parse_qs
 from pathlib import Path
-from pyrogram import Client, filters
+from pyrogram import Client, filters, raw, enums
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from pyrogram.errors import FloodWait, MessageNotModified, MessageIdInvalid
-from flask import Flask
+from pyrogram.errors import FloodWait, MessageNotModified, MessageIdInvalid, BadRequest
+from pyrogram.utils import get_input_media_from_file_id
+from flask import Flask, Response, jsonify
 
 # Load environment variables
 API_ID = os.getenv("API_ID")
@@ -27,16 +42,113 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not all([API_ID, API_HASH, BOT_TOKEN]):
     raise ValueError("API_ID, API_HASH, and BOT_TOKEN must be set in environment variables")
 
-bot = Client("torrent_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# "all" runs everything in one process; "frontend" only takes links and queues them in the
+# job journal, and "worker" processes claim queued jobs from that journal and run them.
+# Each worker needs its own WORKER_ID, stable across restarts so it resumes its own jobs, and,
+# when several run on one host, its own ARIA2_RPC_PORT.
+ROLE = os.getenv("ROLE", "all")
+WORKER_ID = os.getenv("WORKER_ID") or os.uname().nodename
+if ROLE not in ("all", "frontend", "worker"):
+    raise ValueError("ROLE must be one of: all, frontend, worker")
+if ROLE == "worker" and not os.getenv("WORKER_ID"):
+    raise ValueError("WORKER_ID must be set for each worker")
 
-DOWNLOAD_DIR = "downloads"
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+STATE_DIR = os.getenv("STATE_DIR", "state")  # Persistent data that must survive restarts
+# Uploaded .torrent files must be readable by the workers, which share STATE_DIR but not DOWNLOAD_DIR
+TORRENT_DIR = os.path.join(STATE_DIR, "torrents") if ROLE == "frontend" else DOWNLOAD_DIR
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))
 MAX_SIZE = 2000 * 1024 * 1024  # 2GB Telegram upload limit
 MAX_CONCURRENT_DOWNLOADS = 1  # Single task per user
 TIMEOUT = 1800  # 30 minutes
 
+MAX_GLOBAL_DOWNLOADS = int(os.getenv("MAX_GLOBAL_DOWNLOADS", "4"))
+MAX_QUEUED_PER_USER = int(os.getenv("MAX_QUEUED_PER_USER", "3"))
+MIN_FREE_DISK = int(os.getenv("MIN_FREE_DISK_MB", "2048")) * 1024 * 1024
+MAX_TOTAL_BANDWIDTH = int(os.getenv("MAX_TOTAL_BANDWIDTH_MB", "0")) * 1024 * 1024  # bytes/s, 0 = unlimited
+SCHEDULER_INTERVAL = 5
+SCHEDULING = os.getenv("SCHEDULING", "fair")  # "fair" round-robins users, "sjf" starts the smallest job first
+UNKNOWN_JOB_SIZE = int(os.getenv("UNKNOWN_JOB_SIZE_MB", "2048")) * 1024 * 1024  # Assumed until metadata is known
+PREEMPT_MIN_SIZE = int(os.getenv("PREEMPT_MIN_SIZE_MB", "4096")) * 1024 * 1024  # Only pause downloads with this much left
+MAX_PAUSED_DOWNLOADS = int(os.getenv("MAX_PAUSED_DOWNLOADS", "2"))
+MAX_PREEMPT_TIME = int(os.getenv("MAX_PREEMPT_MINUTES", "60")) * 60  # A job is never paused for longer in total
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "3600"))  # Seconds before an idle user's state is dropped
+USER_STATE_MAX = int(os.getenv("USER_STATE_MAX", "10000"))  # Hard cap on users tracked at once
+FILE_PICKER = os.getenv("FILE_PICKER", "1") == "1"  # Ask which files to download for multi-file torrents
+FILE_PICKER_TIMEOUT = int(os.getenv("FILE_PICKER_TIMEOUT", "60"))
+FILE_PICKER_PAGE_SIZE = 8
+MIN_FILE_SIZE = int(os.getenv("MIN_FILE_SIZE_KB", "1")) * 1024
+# Release extras only; executables and databases are often the payload, so skip them only by config
+AUTO_SKIP_EXTENSIONS = {ext.strip().lower() for ext in os.getenv("AUTO_SKIP_EXTENSIONS", ".nfo,.url,.lnk,.txt,.sfv").split(",") if ext.strip()}
+AUTO_SKIP_PATTERN = os.getenv("AUTO_SKIP_PATTERN", r"(?i)(^|[\W_])sample([\W_]|$)")
+DISK_HIGH_WATER = float(os.getenv("DISK_HIGH_WATER", "0.9"))  # Fraction of the download volume a job may fill
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "3"))  # Concurrent pyrogram uploads across all jobs
+FLOOD_RETRIES = 5
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(os.cpu_count() or 2)))  # Concurrent ffmpeg/ffprobe processes
+MEDIA_TOOL_TIMEOUT = 30
+PACK_SMALL_FILES = os.getenv("PACK_SMALL_FILES", "1") == "1"  # Send many small files as tar archives
+PACK_MIN_FILES = int(os.getenv("PACK_MIN_FILES", "20"))  # Pack only when a torrent has at least this many
+PACK_MAX_FILE_SIZE = int(os.getenv("PACK_MAX_FILE_SIZE_MB", "20")) * 1024 * 1024  # Bigger files go alone
+DEDUPE_UPLOADS = os.getenv("DEDUPE_UPLOADS", "1") == "1"  # Re-send identical content by file_id
+DEDUPE_SAMPLES = 64
+DEDUPE_SAMPLE_SIZE = 16 * 1024
+PIPELINED_UPLOADS = os.getenv("PIPELINED_UPLOADS", "1") == "1"  # Upload finished files while the torrent downloads
+
+FS_WORKERS = int(os.getenv("FS_WORKERS", "4"))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+FETCH_TIMEOUT = 30
+MAX_TORRENT_FILE_SIZE = 10 * 1024 * 1024  # Anything bigger is not a .torrent
+FETCH_CACHE_SIZE = 64
+
+CACHE_MAX_TORRENTS = int(os.getenv("CACHE_MAX_TORRENTS", "5000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL_DAYS", "30")) * 86400
+
+PROGRESS_EDIT_INTERVAL = 4  # Minimum seconds between edits of one message
+PROGRESS_EDITS_PER_SECOND = int(os.getenv("PROGRESS_EDITS_PER_SECOND", "20"))  # Across all chats
+PROGRESS_EDITS_IN_FLIGHT = 8
+
+ARIA2_RPC_PORT = int(os.getenv("ARIA2_RPC_PORT", "6800"))
+ARIA2_RPC_SECRET = os.getenv("ARIA2_RPC_SECRET") or secrets.token_hex(16)
+ARIA2_MAX_CONCURRENT = int(os.getenv("ARIA2_MAX_CONCURRENT", "20"))
+ARIA2_POLL_INTERVAL = 1.0
+ARIA2_TUNE_INTERVAL = 15
+ARIA2_RAMP_UP = 60  # Seconds a download runs uncapped before its speed says anything about its swarm
+ARIA2_PEER_BUDGET = int(os.getenv("ARIA2_PEER_BUDGET", "400"))  # bt-max-peers shared by all running torrents
+FALLOC_FILESYSTEMS = {"ext4", "xfs", "btrfs", "f2fs", "ocfs2", "tmpfs"}
+# DHT routing tables and the session file outlive jobs and restarts; one set per aria2 daemon
+ARIA2_STATE_DIR = os.path.join(STATE_DIR, f"aria2-{WORKER_ID}" if ROLE == "worker" else "aria2")
+METADATA_DIR = os.path.join(STATE_DIR, "metadata")  # .torrent files resolved from magnets, by infohash
+DHT_ENTRY_POINT = os.getenv("DHT_ENTRY_POINT", "dht.transmissionbt.com:6881")  # Bootstrap for an empty table
+
+TRACKERS_URL = os.getenv("TRACKERS_URL", "https://raw.githubusercontent.com/ngosang/trackerslist/master/trackers_best.txt")
+TRACKERS_FILE = os.getenv("TRACKERS_FILE", os.path.join(STATE_DIR, "trackers.txt"))  # One announce URL per line
+TRACKER_REFRESH_INTERVAL = int(os.getenv("TRACKER_REFRESH_HOURS", "6")) * 3600
+TRACKER_TOP_K = int(os.getenv("TRACKER_TOP_K", "10"))
+TRACKER_PROBE_TIMEOUT = 5
+DEFAULT_TRACKERS = [
+    "udp://tracker.opentrackr.org:1337/announce",
+    "udp://open.demonii.com:1337/announce",
+    "udp://tracker.torrent.eu.org:451/announce",
+    "udp://exodus.desync.com:6969/announce",
+    "udp://explodie.org:6969/announce",
+    "udp://tracker.moeking.me:6969/announce",
+    "udp://tracker.dler.org:6969/announce",
+    "udp://p4p.arenabg.com:1337/announce",
+    "udp://open.stealth.si:80/announce",
+    "https://tracker.tamersunion.org:443/announce",
+]
+
 MAGNET_REGEX = r"^magnet:\?xt=urn:btih:[a-fA-F0-9]+"
 TORRENT_REGEX = r"^https?://.*\.torrent(?:\?.*)?$"
 
+bot = Client(
+    f"worker_{WORKER_ID}" if ROLE == "worker" else "torrent_bot",
+    api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+    no_updates=ROLE == "worker",
+    # save_file holds one of these per upload; pyrogram's default of 1 would serialize UPLOAD_WORKERS
+    max_concurrent_transmissions=UPLOAD_WORKERS
+)
+
 # Logging setup with rotation
 logging.basicConfig(
     level=logging.INFO,
@@ -50,18 +162,186 @@ file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelnam
 op_logger.addHandler(file_handler)
 op_logger.setLevel(logging.INFO)
 
+# Metrics shared between the bot loop and the Flask thread
+metrics_lock = Lock()
+metric_counters = {}  # (name, labels) -> value
+phase_totals = {}  # phase -> [seconds, count]
+job_stats = {}  # job key -> per-job throughput and phase
+loop_lag = {"current": 0.0, "max": 0.0}
+
+def metric_inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_counters[key] = metric_counters.get(key, 0) + value
+
+def observe_phase(phase, seconds):
+    with metrics_lock:
+        totals = phase_totals.setdefault(phase, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+@contextmanager
+def phase_timer(phase, stats=None):
+    if stats is not None:
+        stats["phase"] = phase
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.monotonic() - started)
+
+def record_upload(stats, delta):
+    metric_inc("upload_bytes_total", delta)
+    if stats is not None:
+        stats["uploaded_bytes"] += delta
+        stats["upload_samples"].append((time.monotonic(), stats["uploaded_bytes"]))
+
+def upload_speed(stats):
+    samples = [s for s in stats["upload_samples"] if time.monotonic() - s[0] < 10]
+    if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+        return 0
+    return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
+
+def new_job_stats(job_key, user_id, name):
+    stats = {
+        "user_id": user_id,
+        "name": name,
+        "phase": "queued",
+        "started": time.time(),
+        "downloaded": 0,
+        "total": 0,
+        "reserved": 0,  # Size of the current streaming batch
+        "backlog": 0,  # Bytes of later streaming batches
+        "download_speed": 0,
+        "uploaded_bytes": 0,
+        "upload_samples": deque(maxlen=64),
+        "gid": None,
+        "downloading": False,  # aria2 is fetching content, whatever the phase says
+        "paused_at": None,  # Set while preempted by smaller jobs
+        "paused_seconds": 0,
+    }
+    job_stats[job_key] = stats
+    return stats
+
+async def loop_lag_monitor():
+    """Measure how late the event loop wakes up from a 1 s sleep."""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(1)
+        lag = max(0.0, time.monotonic() - started - 1)
+        loop_lag["current"] = lag
+        loop_lag["max"] = max(loop_lag["max"], lag)
+
+def host_stats():
+    stats = {"cpu_percent": psutil.cpu_percent(interval=None),
+             "rss_bytes": psutil.Process().memory_info().rss}
+    try:
+        disk = psutil.disk_usage(DOWNLOAD_DIR)
+        stats["disk_free_bytes"] = disk.free
+        stats["disk_used_bytes"] = disk.used
+    except Exception:
+        pass
+    return stats
+
+def status_snapshot():
+    jobs = {}
+    for key, stats in list(job_stats.items()):
+        jobs[str(key)] = {
+            "user_id": stats["user_id"],
+            "name": stats["name"],
+            "phase": stats["phase"],
+            "downloading": stats["downloading"],
+            "paused": bool(stats["paused_at"]),
+            "elapsed": round(time.time() - stats["started"], 1),
+            "downloaded_bytes": stats["downloaded"],
+            "total_bytes": stats["total"],
+            "download_speed": stats["download_speed"],
+            "uploaded_bytes": stats["uploaded_bytes"],
+            "upload_speed": round(upload_speed(stats)),
+        }
+    with metrics_lock:
+        phases = {p: {"seconds": round(t[0], 3), "count": t[1]} for p, t in phase_totals.items()}
+        counters = {name + (str(dict(labels)) if labels else ""): value
+                    for (name, labels), value in metric_counters.items()}
+    return {
+        "jobs": jobs,
+        "running_jobs": len(running_jobs),
+        "paused_downloads": sum(job["paused"] for job in jobs.values()),
+        "queue_depth": journal_queue_depth() if ROLE == "frontend" else
+                       {str(user_id): len(state.queue) for user_id, state in users.items() if state.queue},
+        "users_tracked": len(users),
+        "download_speed": sum(job["download_speed"] for job in jobs.values()),
+        "upload_speed": sum(job["upload_speed"] for job in jobs.values()),
+        "phases": phases,
+        "counters": counters,
+        "event_loop_lag": {"current": round(loop_lag["current"], 4), "max": round(loop_lag["max"], 4)},
+        "host": host_stats(),
+    }
+
+def render_metrics(snapshot):
+    """Render a status snapshot in the Prometheus text exposition format."""
+    lines = []
+
+    def add(name, kind, samples):
+        lines.append(f"# TYPE torrentbot_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"torrentbot_{name}{{{label_text}}} {value}" if label_text else f"torrentbot_{name} {value}")
+
+    jobs = snapshot["jobs"]
+    add("jobs_running", "gauge", [({}, snapshot["running_jobs"])])
+    add("downloads_paused", "gauge", [({}, snapshot["paused_downloads"])])
+    add("users_tracked", "gauge", [({}, snapshot["users_tracked"])])
+    add("queue_depth", "gauge", [({"user": u}, n) for u, n in snapshot["queue_depth"].items()])
+    add("job_download_speed_bytes", "gauge", [({"job": k}, j["download_speed"]) for k, j in jobs.items()])
+    add("job_upload_speed_bytes", "gauge", [({"job": k}, j["upload_speed"]) for k, j in jobs.items()])
+    add("download_speed_bytes", "gauge", [({}, snapshot["download_speed"])])
+    add("upload_speed_bytes", "gauge", [({}, snapshot["upload_speed"])])
+    add("phase_seconds_sum", "counter", [({"phase": p}, t["seconds"]) for p, t in snapshot["phases"].items()])
+    add("phase_seconds_count", "counter", [({"phase": p}, t["count"]) for p, t in snapshot["phases"].items()])
+    with metrics_lock:
+        counters = list(metric_counters.items())
+    for name in sorted({name for (name, _), _ in counters}):
+        add(name, "counter", [(dict(labels), value) for (n, labels), value in counters if n == name])
+    add("event_loop_lag_seconds", "gauge", [({}, snapshot["event_loop_lag"]["current"])])
+    add("event_loop_lag_max_seconds", "gauge", [({}, snapshot["event_loop_lag"]["max"])])
+    for key, value in snapshot["host"].items():
+        add(key, "gauge", [({}, value)])
+    return "\n".join(lines) + "\n"
+
 # Flask health check
 flask_app = Flask(__name__)
 @flask_app.route('/')
 def home():
     return "Bot is running ✅"
+
+@flask_app.route('/status')
+def status():
+    return jsonify(status_snapshot())
+
+@flask_app.route('/metrics')
+def metrics():
+    return Response(render_metrics(status_snapshot()), mimetype="text/plain; version=0.0.4")
+
 try:
-    Thread(target=lambda: flask_app.run(host="0.0.0.0", port=8080), daemon=True).start()
+    Thread(target=lambda: flask_app.run(host="0.0.0.0", port=HEALTH_PORT), daemon=True).start()
 except Exception as e:
     op_logger.error(f"Flask server failed to start: {str(e)}")
 
-# Global process tracking
-aria_processes = []
+# Coalesced progress edits, keyed by (chat_id, message_id)
+pending_edits = OrderedDict()
+last_edit_at = {}
+chat_blocked_until = {}
+progress_wakeup = asyncio.Event()
+edit_slots = asyncio.Semaphore(PROGRESS_EDITS_IN_FLIGHT)
+
+# Blocking filesystem calls run here instead of on the event loop
+fs_executor = ThreadPoolExecutor(max_workers=FS_WORKERS, thread_name_prefix="fs")
+
+# Persistent aria2 RPC daemon shared by every job
+aria2_process = None
+aria2_start_lock = Lock()  # start_aria2_daemon runs in worker threads
+aria2_client = aria2p.Client(host="http://127.0.0.1", port=ARIA2_RPC_PORT, secret=ARIA2_RPC_SECRET)
 
 def human_readable_size(size, decimal_places=2):
     for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
@@ -78,39 +358,312 @@ def progress_bar(percentage, bar_length=20):
     return "█" * filled + "░" * empty
 
 async def safe_edit_message(message, text):
+    """Edit a status message now, superseding any queued progress edit for it."""
+    key = (message.chat.id, message.id)
+    pending_edits.pop(key, None)
+    last_edit_at[key] = time.time()
     try:
         await message.edit_text(text)
         return True
     except FloodWait as e:
-        await asyncio.sleep(e.x)
-        return await safe_edit_message(message, text)
+        # Let the progress updater deliver it once the wait is over
+        metric_inc("floodwait_total", source="status")
+        metric_inc("floodwait_seconds_total", e.value, source="status")
+        chat_blocked_until[key[0]] = time.time() + e.value
+        pending_edits[key] = (message, text, True)
+        progress_wakeup.set()
+        return True
     except (MessageNotModified, MessageIdInvalid):
         return True
     except Exception as e:
         op_logger.error(f"Error editing message: {str(e)}")
         return False
 
-def split_large_file(file_path, chunk_size=MAX_SIZE):
+def post_progress(message, text):
+    """Queue a progress edit without waiting; only the newest text per message is kept."""
+    pending_edits[(message.chat.id, message.id)] = (message, text, False)
+    progress_wakeup.set()
+
+def forget_progress(message):
+    """Drop progress state for a finished job, keeping a final status that still has to be sent."""
+    key = (message.chat.id, message.id)
+    if key in pending_edits and pending_edits[key][2]:
+        return
+    pending_edits.pop(key, None)
+    last_edit_at.pop(key, None)
+    if chat_blocked_until.get(key[0], 0) < time.time():
+        chat_blocked_until.pop(key[0], None)
+
+async def apply_progress_edit(key, message, text, final):
     try:
-        part_num = 1
-        output_files = []
-        base_name = os.path.basename(file_path)
-        
-        with open(file_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                part_name = f"{base_name}.part{part_num:03d}"
-                part_path = os.path.join(os.path.dirname(file_path), part_name)
-                with open(part_path, 'wb') as p:
-                    p.write(chunk)
-                output_files.append(part_path)
-                part_num += 1
-        return output_files
+        await message.edit_text(text)
+        if final:
+            last_edit_at.pop(key, None)
+    except FloodWait as e:
+        op_logger.warning(f"FloodWait on progress edit: {e.value}s")
+        metric_inc("floodwait_total", source="progress")
+        metric_inc("floodwait_seconds_total", e.value, source="progress")
+        chat_blocked_until[key[0]] = time.time() + e.value
+        # Retry later unless the job finished meanwhile; its progress text is stale by then
+        if final or key in last_edit_at:
+            pending_edits.setdefault(key, (message, text, final))
+            progress_wakeup.set()
+    except (MessageNotModified, MessageIdInvalid):
+        pass
     except Exception as e:
-        op_logger.error(f"Error splitting file {file_path}: {str(e)}")
-        return []
+        op_logger.error(f"Error editing message: {str(e)}")
+    finally:
+        edit_slots.release()
+
+async def progress_updater():
+    """Single writer for progress edits, paced by a global edit budget."""
+    while True:
+        progress_wakeup.clear()
+        now = time.time()
+        next_due = None
+        for key in pending_edits:
+            due = max(last_edit_at.get(key, 0) + PROGRESS_EDIT_INTERVAL, chat_blocked_until.get(key[0], 0))
+            if due <= now:
+                break
+            next_due = due if next_due is None else min(next_due, due)
+        else:
+            key = None
+
+        if key is None:
+            timeout = max(0.05, next_due - now) if next_due else None
+            try:
+                await asyncio.wait_for(progress_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        message, text, final = pending_edits.pop(key)
+        last_edit_at[key] = now
+        await edit_slots.acquire()
+        asyncio.create_task(apply_progress_edit(key, message, text, final))
+        await asyncio.sleep(1 / PROGRESS_EDITS_PER_SECOND)
+
+class FileSlice(io.RawIOBase):
+    """Read-only window over a byte range of a file, uploaded as if it were a separate part."""
+
+    def __init__(self, path, offset, length, name):
+        super().__init__()
+        self._fp = open(path, "rb", buffering=0)
+        self._offset = offset
+        self._length = length
+        self._pos = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def readinto(self, buffer):
+        remaining = self._length - self._pos
+        if remaining <= 0:
+            return 0
+        view = memoryview(buffer)[:remaining]
+        self._fp.seek(self._offset + self._pos)
+        read = self._fp.readinto(view) or 0
+        self._pos += read
+        return read
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+        super().close()
+
+class TarStream(io.RawIOBase):
+    """Uncompressed tar of several files, generated while it is read; nothing is staged on disk."""
+
+    def __init__(self, members, name):
+        super().__init__()
+        self.name = name
+        self._segments = []  # (start, length, bytes or file path)
+        size = 0
+        for path, arcname in members:
+            info = tarfile.TarInfo(arcname)
+            stat = os.stat(path)
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = 0o644
+            for chunk in (info.tobuf(format=tarfile.PAX_FORMAT), str(path), bytes(-info.size % 512)):
+                length = info.size if isinstance(chunk, str) else len(chunk)
+                if length:
+                    self._segments.append((size, length, chunk))
+                    size += length
+        self._segments.append((size, 1024, bytes(1024)))  # End-of-archive marker
+        self._length = size + 1024
+        self._starts = [segment[0] for segment in self._segments]
+        self._pos = 0
+        self._fp = None
+        self._fp_path = None
+
+    @staticmethod
+    def member_size(size, arcname):
+        """Bytes one member adds to the archive: its header and its data padded to a block."""
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        return len(info.tobuf(format=tarfile.PAX_FORMAT)) + size + (-size % 512)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._length
+        self._pos = max(0, min(pos, self._length))
+        return self._pos
+
+    def readinto(self, buffer):
+        # Always fill the buffer across member boundaries: pyrogram sends each read as one part
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view) and self._pos < self._length:
+            index = bisect.bisect_right(self._starts, self._pos) - 1
+            start, length, chunk = self._segments[index]
+            within = self._pos - start
+            count = min(len(view) - filled, length - within)
+            if isinstance(chunk, bytes):
+                view[filled:filled + count] = chunk[within:within + count]
+            else:
+                if self._fp_path != chunk:
+                    if self._fp:
+                        self._fp.close()
+                    self._fp = open(chunk, "rb", buffering=0)
+                    self._fp_path = chunk
+                self._fp.seek(within)
+                count = self._fp.readinto(view[filled:filled + count]) or 0
+                if not count:
+                    raise IOError(f"{chunk} shrank while it was being archived")
+            filled += count
+            self._pos += count
+        return filled
+
+    def close(self):
+        if not self.closed and self._fp:
+            self._fp.close()
+        super().close()
+
+def plan_archive_volumes(files, root, max_size=MAX_SIZE):
+    """Group (path, file_index) into tar volumes of at most max_size; yields (path, arcname, index) lists."""
+    volumes = []
+    current = []
+    current_size = 1024  # End-of-archive marker
+    for path, file_index in files:
+        arcname = os.path.relpath(path, root)
+        member = TarStream.member_size(os.path.getsize(path), arcname)
+        if current and current_size + member > max_size:
+            volumes.append(current)
+            current = []
+            current_size = 1024
+        current.append((path, arcname, file_index))
+        current_size += member
+    if current:
+        volumes.append(current)
+    return volumes
+
+class HashingReader(io.RawIOBase):
+    """Passes reads through while hashing them, so the upload itself yields the content digest."""
+
+    def __init__(self, raw_file, length):
+        super().__init__()
+        self._raw = raw_file
+        self._length = length
+        self.name = raw_file.name
+        self._hash = hashlib.blake2b()
+        self._hashed = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._raw.tell()
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        pos = self._raw.seek(pos, whence)
+        if pos == 0:
+            # A retried upload starts over
+            self._hash = hashlib.blake2b()
+            self._hashed = 0
+        return pos
+
+    def readinto(self, buffer):
+        pos = self._raw.tell()
+        read = self._raw.readinto(buffer)
+        if read and pos == self._hashed:
+            self._hash.update(memoryview(buffer)[:read])
+            self._hashed += read
+        return read
+
+    def hexdigest(self):
+        """Digest of the whole content, or None if it was not read through in order."""
+        return self._hash.hexdigest() if self._hashed == self._length else None
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+def content_fingerprint(path, offset, length):
+    """Cheap identity key for a byte range: its size plus a blake2b over evenly spaced samples."""
+    digest = hashlib.blake2b(str(length).encode(), digest_size=20)
+    with open(path, "rb") as f:
+        if length <= DEDUPE_SAMPLES * DEDUPE_SAMPLE_SIZE:
+            f.seek(offset)
+            digest.update(f.read(length))
+        else:
+            step = (length - DEDUPE_SAMPLE_SIZE) // (DEDUPE_SAMPLES - 1)
+            for sample in range(DEDUPE_SAMPLES):
+                f.seek(offset + sample * step)
+                digest.update(f.read(DEDUPE_SAMPLE_SIZE))
+    return digest.hexdigest()
+
+def content_digest(path, offset, length):
+    """Full blake2b of a byte range, the same digest HashingReader yields while uploading it."""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(length, 1024 * 1024))
+            if not chunk:
+                break
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
+
+def split_large_file(file_path, chunk_size=MAX_SIZE):
+    """Return (offset, length, part_name) windows covering the file; nothing is copied."""
+    size = os.path.getsize(file_path)
+    base_name = os.path.basename(file_path)
+    return [
+        (offset, min(chunk_size, size - offset), f"{base_name}.part{part_num:03d}")
+        for part_num, offset in enumerate(range(0, size, chunk_size), 1)
+    ]
 
 def clean_directory(directory):
     try:
@@ -121,41 +674,107 @@ def clean_directory(directory):
         op_logger.error(f"Error cleaning directory: {str(e)}")
         return False
 
-def extract_thumbnail(video_path):
+async def run_fs(func, *args, **kwargs):
+    """Run blocking filesystem work on the dedicated fs thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(fs_executor, functools.partial(func, *args, **kwargs))
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+def remove_path(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        op_logger.error(f"Error removing {path}: {str(e)}")
+
+def find_stale_entries(directory, max_age, keep):
+    """List top-level entries of directory older than max_age that are not in keep."""
+    stale = []
+    now = time.time()
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                path = os.path.abspath(entry.path)
+                if path in keep:
+                    continue
+                try:
+                    if now - entry.stat(follow_symlinks=False).st_mtime > max_age:
+                        stale.append(path)
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return stale
+
+async def run_media_tool(cmd):
+    """Run ffmpeg/ffprobe without blocking the event loop and return its stdout."""
+    async with media_slots:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), MEDIA_TOOL_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+        return stdout
+
+async def probe_media(file_path):
+    """Read duration, dimensions and codec of a media file with a single ffprobe call."""
+    info = {"duration": 0, "width": 0, "height": 0, "codec": None}
+    if not shutil.which("ffprobe"):
+        op_logger.error("ffprobe not found")
+        return info
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-print_format", "json",
+        "-show_format", "-show_streams",
+        file_path
+    ]
+    try:
+        data = json.loads(await run_media_tool(cmd) or b"{}")
+        info["duration"] = int(float(data.get("format", {}).get("duration", 0)))
+        streams = data.get("streams", [])
+        video = next((st for st in streams if st.get("codec_type") == "video"), None)
+        stream = video or next((st for st in streams if st.get("codec_type") == "audio"), None)
+        if video:
+            info["width"] = int(video.get("width", 0))
+            info["height"] = int(video.get("height", 0))
+        if stream:
+            info["codec"] = stream.get("codec_name")
+    except Exception as e:
+        op_logger.error(f"Media probe failed for {file_path}: {str(e)}")
+    return info
+
+async def extract_thumbnail(video_path):
     try:
         if not shutil.which("ffmpeg"):
             op_logger.error("ffmpeg not found")
             return None
-        thumbnail_path = os.path.join(os.path.dirname(video_path), "thumbnail.jpg")
+        thumbnail_path = f"{video_path}.thumb.jpg"
         cmd = [
-            "ffmpeg", "-ss", "00:00:10",
+            "ffmpeg", "-y", "-ss", "00:00:10",
             "-i", video_path,
             "-vframes", "1",
             "-q:v", "2",
             thumbnail_path
         ]
-        subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+        await run_media_tool(cmd)
         return thumbnail_path if os.path.exists(thumbnail_path) else None
     except Exception as e:
         op_logger.error(f"Thumbnail extraction failed: {str(e)}")
         return None
 
-def get_duration(file_path):
-    try:
-        if not shutil.which("ffprobe"):
-            op_logger.error("ffprobe not found")
-            return 0
-        cmd = [
-            "ffprobe", "-v", "error",
-            "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            file_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        return int(float(result.stdout.strip()))
-    except Exception:
-        return 0
-
 def sanitize_filename(filename):
     return re.sub(r'[\\/*?:"<>|]', "_", filename.strip())
 
@@ -171,15 +790,6 @@ def get_magnet_name(magnet_link):
     except Exception:
         return "Unknown-Torrent"
 
-def kill_aria_processes():
-    global aria_processes
-    for proc in aria_processes:
-        try:
-            proc.kill()
-        except Exception as e:
-            op_logger.error(f"Error killing aria2c process: {str(e)}")
-    aria_processes.clear()
-
 def time_formatter(seconds: float) -> str:
     if seconds < 0:
         seconds = 0
@@ -191,10 +801,568 @@ def natural_sort_key(filename):
     """Sort filenames naturally, e.g., '1.mp3', '2.mp3', '10.mp3'."""
     return [int(c) if c.isdigit() else c.lower() for c in re.split(r'(\d+)', filename)]
 
-user_queues = {}
-user_messages = {}
-active_downloads = {}
-user_active_tasks = {}
+# Pooled HTTP session for .torrent URLs, used from a dedicated thread pool
+http_session = requests.Session()
+http_session.headers["User-Agent"] = "Mozilla/5.0"
+http_session.mount("http://", HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+http_session.mount("https://", HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS))
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+fetch_cache = OrderedDict()  # url -> (etag, last_modified, filename, content)
+fetch_cache_lock = Lock()
+
+def fetch_torrent_blocking(url):
+    with fetch_cache_lock:
+        cached = fetch_cache.get(url)
+    headers = {}
+    if cached:
+        if cached[0]:
+            headers["If-None-Match"] = cached[0]
+        if cached[1]:
+            headers["If-Modified-Since"] = cached[1]
+
+    with http_session.get(url, headers=headers, timeout=FETCH_TIMEOUT, stream=True) as response:
+        if response.status_code == 304 and cached:
+            with fetch_cache_lock:
+                fetch_cache.move_to_end(url)
+            return cached[2], cached[3]
+        response.raise_for_status()
+
+        if int(response.headers.get("content-length") or 0) > MAX_TORRENT_FILE_SIZE:
+            raise ValueError("torrent file is too large")
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(64 * 1024):
+            received += len(chunk)
+            if received > MAX_TORRENT_FILE_SIZE:
+                raise ValueError("torrent file is too large")
+            chunks.append(chunk)
+        content = b"".join(chunks)
+
+        names = re.findall(r'filename\*?=[\'"]?(?:UTF-\d[\'"]*)?([^;\'"]+)',
+                           response.headers.get("content-disposition", ""),
+                           re.IGNORECASE)
+        filename = unquote(names[0] if names else os.path.basename(urlparse(url).path))
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+
+    if etag or last_modified:
+        with fetch_cache_lock:
+            fetch_cache[url] = (etag, last_modified, filename, content)
+            fetch_cache.move_to_end(url)
+            while len(fetch_cache) > FETCH_CACHE_SIZE:
+                fetch_cache.popitem(last=False)
+    return filename, content
+
+async def fetch_torrent(url):
+    """Download a .torrent URL off the event loop. Returns (filename, content)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(fetch_executor, fetch_torrent_blocking, url)
+
+def magnet_infohash(magnet_link):
+    """Return the lowercase hex BTIH of a magnet link, decoding base32 hashes."""
+    try:
+        xt = parse_qs(urlparse(magnet_link.strip()).query).get('xt', [''])[0]
+        btih = xt.split('urn:btih:')[-1]
+        if len(btih) == 40:
+            return btih.lower()
+        if len(btih) == 32:
+            return base64.b32decode(btih.upper()).hex()
+    except Exception:
+        pass
+    return None
+
+def message_file_id(message):
+    media = message and (message.video or message.audio or message.photo or message.document)
+    return media.file_id if media else None
+
+# Result cache: infohash -> Telegram file_ids of everything we already uploaded
+cache_db = None
+
+def get_cache_db():
+    global cache_db
+    if cache_db is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        cache_db = sqlite3.connect(
+            os.path.join(STATE_DIR, "cache.db"), check_same_thread=False, isolation_level=None
+        )
+        cache_db.execute("PRAGMA journal_mode=WAL")
+        cache_db.executescript("""
+            CREATE TABLE IF NOT EXISTS torrents (
+                infohash TEXT PRIMARY KEY,
+                name TEXT,
+                complete INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS trackers (
+                url TEXT PRIMARY KEY,
+                score REAL NOT NULL,  -- moving average of probe success, 0..1
+                latency REAL,  -- moving average of successful probe round trips, seconds
+                checked REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS content_index (
+                fingerprint TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,  -- blake2b of the full content, computed while uploading
+                file_id TEXT,  -- NULL once two different contents shared the fingerprint
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cached_files (
+                infohash TEXT NOT NULL,
+                file_index INTEGER NOT NULL,
+                part INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                caption TEXT,
+                PRIMARY KEY (infohash, file_index, part)
+            );
+        """)
+    return cache_db
+
+def cache_begin(infohash, name):
+    """Start (or restart) recording uploads for a torrent."""
+    db = get_cache_db()
+    now = time.time()
+    db.execute("DELETE FROM cached_files WHERE infohash = ?", (infohash,))
+    db.execute(
+        "INSERT OR REPLACE INTO torrents (infohash, name, complete, created, last_used) VALUES (?, ?, 0, ?, ?)",
+        (infohash, name, now, now)
+    )
+
+def cache_store_file(infohash, file_index, part, name, file_id, caption):
+    get_cache_db().execute(
+        "INSERT OR REPLACE INTO cached_files (infohash, file_index, part, name, file_id, caption) VALUES (?, ?, ?, ?, ?, ?)",
+        (infohash, file_index, part, name, file_id, caption)
+    )
+
+def cache_complete(infohash):
+    db = get_cache_db()
+    db.execute("UPDATE torrents SET complete = 1 WHERE infohash = ?", (infohash,))
+    cache_evict()
+
+def cache_invalidate(infohash):
+    db = get_cache_db()
+    db.execute("DELETE FROM cached_files WHERE infohash = ?", (infohash,))
+    db.execute("DELETE FROM torrents WHERE infohash = ?", (infohash,))
+
+def cache_evict():
+    """Drop entries unused for CACHE_TTL, then the least recently used beyond CACHE_MAX_TORRENTS."""
+    db = get_cache_db()
+    stale = [row[0] for row in db.execute(
+        "SELECT infohash FROM torrents WHERE last_used < ?", (time.time() - CACHE_TTL,)
+    )]
+    stale += [row[0] for row in db.execute(
+        "SELECT infohash FROM torrents WHERE last_used >= ? ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+        (time.time() - CACHE_TTL, CACHE_MAX_TORRENTS)
+    )]
+    for infohash in stale:
+        cache_invalidate(infohash)
+    db.execute("DELETE FROM content_index WHERE last_used < ?", (time.time() - CACHE_TTL,))
+
+def dedupe_lookup(fingerprint):
+    db = get_cache_db()
+    row = db.execute(
+        "SELECT file_id, digest FROM content_index WHERE fingerprint = ? AND file_id IS NOT NULL", (fingerprint,)
+    ).fetchone()
+    if row:
+        db.execute("UPDATE content_index SET last_used = ? WHERE fingerprint = ?", (time.time(), fingerprint))
+    return tuple(row) if row else (None, None)
+
+def dedupe_record(fingerprint, digest, file_id):
+    """Remember an upload's file_id; a different content under the same fingerprint disables reuse."""
+    db = get_cache_db()
+    row = db.execute("SELECT digest FROM content_index WHERE fingerprint = ?", (fingerprint,)).fetchone()
+    if row and row[0] != digest:
+        metric_inc("dedupe_collisions_total")
+        db.execute(
+            "UPDATE content_index SET file_id = NULL, last_used = ? WHERE fingerprint = ?", (time.time(), fingerprint)
+        )
+        return
+    db.execute(
+        "INSERT OR REPLACE INTO content_index (fingerprint, digest, file_id, last_used) VALUES (?, ?, ?, ?)",
+        (fingerprint, digest, file_id, time.time())
+    )
+
+def dedupe_forget(fingerprint):
+    get_cache_db().execute("DELETE FROM content_index WHERE fingerprint = ?", (fingerprint,))
+
+def cache_lookup(infohash):
+    db = get_cache_db()
+    row = db.execute("SELECT complete FROM torrents WHERE infohash = ?", (infohash,)).fetchone()
+    if not row or not row[0]:
+        return []
+    db.execute("UPDATE torrents SET last_used = ? WHERE infohash = ?", (time.time(), infohash))
+    rows = db.execute(
+        "SELECT name, part, file_id, caption FROM cached_files WHERE infohash = ?", (infohash,)
+    ).fetchall()
+    rows.sort(key=lambda row: (natural_sort_key(row[0]), row[1]))
+    return [(file_id, caption) for _, _, file_id, caption in rows]
+
+async def send_from_cache(msg, infohash):
+    """Re-send a previously uploaded torrent by file_id. Returns False if it has to be downloaded."""
+    try:
+        entries = cache_lookup(infohash)
+    except Exception as e:
+        op_logger.error(f"Cache lookup failed: {str(e)}")
+        return False
+    if not entries:
+        return False
+
+    await safe_edit_message(msg, f"⚡ Found in cache, sending {len(entries)} files...")
+    for file_id, caption in entries:
+        try:
+            await with_flood_retry(
+                bot.send_cached_media, msg.chat.id, file_id,
+                caption=caption, parse_mode=enums.ParseMode.DISABLED
+            )
+        except BadRequest as e:
+            op_logger.warning(f"Cached file_id for {infohash} no longer works: {str(e)}")
+            cache_invalidate(infohash)
+            return False
+    op_logger.info(f"Served {infohash} from cache")
+    return True
+
+# Tracker health: probe the known trackers and hand new jobs only the best ones
+best_trackers = []
+
+def load_tracker_list():
+    """Fetch the tracker source into TRACKERS_FILE, falling back to the last saved copy."""
+    if TRACKERS_URL:
+        try:
+            response = http_session.get(TRACKERS_URL, timeout=FETCH_TIMEOUT)
+            response.raise_for_status()
+            os.makedirs(os.path.dirname(TRACKERS_FILE) or ".", exist_ok=True)
+            with open(TRACKERS_FILE, "w") as f:
+                f.write(response.text)
+        except Exception as e:
+            op_logger.error(f"Tracker list refresh failed: {str(e)}")
+    trackers = []
+    try:
+        with open(TRACKERS_FILE) as f:
+            trackers = [line.strip() for line in f if re.match(r"^(udp|https?)://", line.strip())]
+    except FileNotFoundError:
+        pass
+    return list(dict.fromkeys(trackers)) or DEFAULT_TRACKERS
+
+async def probe_udp_tracker(url):
+    """BEP 15 connect handshake; any valid connect reply means the tracker is up."""
+    parsed = urlparse(url)
+    loop = asyncio.get_running_loop()
+    reply = loop.create_future()
+
+    class ConnectProtocol(asyncio.DatagramProtocol):
+        def datagram_received(self, data, addr):
+            if not reply.done():
+                reply.set_result(data)
+
+        def error_received(self, exc):
+            if not reply.done():
+                reply.set_exception(exc)
+
+    transaction_id = secrets.randbits(32)
+    transport, _ = await loop.create_datagram_endpoint(
+        ConnectProtocol, remote_addr=(parsed.hostname, parsed.port or 80)
+    )
+    try:
+        transport.sendto(struct.pack(">QII", 0x41727101980, 0, transaction_id))
+        data = await reply
+        return len(data) >= 16 and struct.unpack(">II", data[:8]) == (0, transaction_id)
+    finally:
+        transport.close()
+
+def probe_http_tracker(url):
+    # Any HTTP answer, even an error for the missing announce parameters, means it is up
+    with http_session.get(url, timeout=TRACKER_PROBE_TIMEOUT, stream=True, allow_redirects=False):
+        return True
+
+async def probe_tracker(url):
+    """Return the probe round trip in seconds, or None if the tracker did not answer."""
+    started = time.monotonic()
+    try:
+        if url.startswith("udp://"):
+            ok = await asyncio.wait_for(probe_udp_tracker(url), TRACKER_PROBE_TIMEOUT)
+        else:
+            ok = await asyncio.get_running_loop().run_in_executor(fetch_executor, probe_http_tracker, url)
+    except Exception:
+        ok = False
+    metric_inc("tracker_probes_total", result="ok" if ok else "failed")
+    return time.monotonic() - started if ok else None
+
+def rank_trackers(trackers):
+    """Top TRACKER_TOP_K of the given trackers by health score, then latency."""
+    db = get_cache_db()
+    scores = {url: (score, latency) for url, score, latency in db.execute("SELECT url, score, latency FROM trackers")}
+
+    def rank(url):
+        # Trackers that were never probed start at an even score
+        score, latency = scores.get(url, (0.5, None))
+        return -score, latency if latency is not None else TRACKER_PROBE_TIMEOUT
+
+    healthy = [url for url in trackers if scores.get(url, (0.5, None))[0] > 0.1]
+    return sorted(healthy, key=rank)[:TRACKER_TOP_K]
+
+async def refresh_trackers():
+    global best_trackers
+    trackers = await asyncio.get_running_loop().run_in_executor(fetch_executor, load_tracker_list)
+    results = await asyncio.gather(*(probe_tracker(url) for url in trackers))
+
+    db = get_cache_db()
+    now = time.time()
+    for url, latency in zip(trackers, results):
+        row = db.execute("SELECT score, latency FROM trackers WHERE url = ?", (url,)).fetchone()
+        score, average = row if row else (0.5, None)
+        score = 0.7 * score + 0.3 * (1.0 if latency is not None else 0.0)
+        if latency is not None:
+            average = latency if average is None else 0.7 * average + 0.3 * latency
+        db.execute(
+            "INSERT OR REPLACE INTO trackers (url, score, latency, checked) VALUES (?, ?, ?, ?)",
+            (url, score, average, now)
+        )
+    db.execute("DELETE FROM trackers WHERE checked < ?", (now - 7 * 86400,))
+
+    best_trackers = rank_trackers(trackers)
+    alive = sum(latency is not None for latency in results)
+    op_logger.info(f"Trackers: {alive}/{len(trackers)} answered, using {len(best_trackers)}")
+
+async def tracker_scheduler():
+    while True:
+        try:
+            await refresh_trackers()
+        except Exception as e:
+            op_logger.error(f"Tracker refresh error: {str(e)}")
+        await asyncio.sleep(TRACKER_REFRESH_INTERVAL)
+
+# Job journal: queued and running jobs survive restarts
+jobs_db = None
+
+def get_jobs_db():
+    global jobs_db
+    if jobs_db is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        jobs_db = sqlite3.connect(
+            os.path.join(STATE_DIR, "jobs.db"), check_same_thread=False, isolation_level=None
+        )
+        jobs_db.row_factory = sqlite3.Row
+        jobs_db.execute("PRAGMA journal_mode=WAL")
+        jobs_db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                link TEXT NOT NULL,
+                state TEXT NOT NULL,
+                dir TEXT,
+                gid TEXT,
+                file_count INTEGER,
+                selected TEXT,
+                worker TEXT,
+                size INTEGER,  -- Bytes to download, once known
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_files (
+                job_id INTEGER NOT NULL,
+                file_index INTEGER NOT NULL,
+                part INTEGER NOT NULL,  -- 0 marks the whole file as delivered
+                PRIMARY KEY (job_id, file_index, part)
+            );
+        """)
+        columns = {row[1] for row in jobs_db.execute("PRAGMA table_info(jobs)")}
+        for column, kind in (("selected", "TEXT"), ("worker", "TEXT"), ("size", "INTEGER")):
+            if column not in columns:
+                jobs_db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+    return jobs_db
+
+def journal_add(user_id, link, size=None):
+    now = time.time()
+    cursor = get_jobs_db().execute(
+        "INSERT INTO jobs (user_id, link, state, size, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)",
+        (user_id, link, size, now, now)
+    )
+    return cursor.lastrowid
+
+def journal_update(job_id, **fields):
+    if not job_id:
+        return
+    fields["updated"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    get_jobs_db().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    if fields.get("state") in ("done", "failed"):
+        get_jobs_db().execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+
+def journal_get(job_id):
+    if not job_id:
+        return None
+    return get_jobs_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+def journal_parts_done(job_id):
+    rows = get_jobs_db().execute("SELECT file_index, part FROM job_files WHERE job_id = ?", (job_id,))
+    return {(row[0], row[1]) for row in rows}
+
+def journal_part_done(job_id, file_index, part):
+    if job_id:
+        get_jobs_db().execute(
+            "INSERT OR IGNORE INTO job_files (job_id, file_index, part) VALUES (?, ?, ?)",
+            (job_id, file_index, part)
+        )
+
+def journal_unfinished():
+    return get_jobs_db().execute(
+        "SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY state = 'queued', id"
+    ).fetchall()
+
+def journal_active_paths():
+    """Directories and uploaded .torrent files that unfinished jobs still need."""
+    rows = get_jobs_db().execute("SELECT dir, link FROM jobs WHERE state IN ('queued', 'running')")
+    paths = set()
+    for row in rows:
+        if row["dir"]:
+            paths.add(os.path.abspath(row["dir"]))
+        if not re.match(r"^(magnet:|https?://)", row["link"], re.IGNORECASE):
+            paths.add(os.path.abspath(row["link"]))
+    return paths
+
+def journal_queue_depth():
+    rows = get_jobs_db().execute("SELECT user_id, COUNT(*) FROM jobs WHERE state = 'queued' GROUP BY user_id")
+    return {str(user_id): count for user_id, count in rows}
+
+def journal_queued_sizes():
+    rows = get_jobs_db().execute("SELECT id, size FROM jobs WHERE state = 'queued' AND size IS NOT NULL")
+    return dict(rows.fetchall())
+
+# Queued jobs a worker may claim: its own interrupted ones, or those of users below MAX_CONCURRENT_DOWNLOADS
+CLAIMABLE_JOBS = """
+    FROM jobs q
+    WHERE q.state = 'queued' AND (q.worker IS NULL OR q.worker = :worker)
+    AND (q.worker = :worker OR (
+        SELECT COUNT(*) FROM jobs r WHERE r.user_id = q.user_id AND r.state = 'running'
+    ) < :limit)
+"""
+
+def journal_claimable(worker_id):
+    return get_jobs_db().execute(
+        "SELECT 1 FROM jobs WHERE state = 'queued' AND (worker IS NULL OR worker = ?) LIMIT 1", (worker_id,)
+    ).fetchone() is not None
+
+def journal_claim(worker_id):
+    """Atomically hand the next queued job to a worker; returns (job_id, user_id, link) or None."""
+    # The worker's own interrupted jobs come first since their files are on its disk; otherwise
+    # users with the fewest running jobs go first (unless SCHEDULING is "sjf"), then the smallest jobs.
+    fair_share = "(SELECT COUNT(*) FROM jobs r WHERE r.user_id = q.user_id AND r.state = 'running')," \
+        if SCHEDULING == "fair" else ""
+    db = get_jobs_db()
+    # BEGIN IMMEDIATE takes the write lock before the SELECT, so two workers cannot pick the
+    # same row (UPDATE ... RETURNING would need SQLite 3.35, newer than Debian bullseye's)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute(f"""
+            SELECT q.id, q.user_id, q.link {CLAIMABLE_JOBS}
+            ORDER BY q.worker IS NULL, {fair_share} COALESCE(q.size, :unknown), q.id
+            LIMIT 1
+        """, {"worker": worker_id, "limit": MAX_CONCURRENT_DOWNLOADS, "unknown": UNKNOWN_JOB_SIZE}).fetchone()
+        if row:
+            db.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, updated = ? WHERE id = ? AND state = 'queued'",
+                (worker_id, time.time(), row["id"])
+            )
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return tuple(row) if row else None
+
+def journal_smallest_claimable(worker_id):
+    """Estimated size of the smallest job a worker could claim, or None if there is none."""
+    return get_jobs_db().execute(
+        f"SELECT MIN(COALESCE(q.size, :unknown)) {CLAIMABLE_JOBS}",
+        {"worker": worker_id, "limit": MAX_CONCURRENT_DOWNLOADS, "unknown": UNKNOWN_JOB_SIZE}
+    ).fetchone()[0]
+
+def journal_release(worker_id):
+    """Requeue the jobs a worker was running when it stopped; only that worker may claim them."""
+    cursor = get_jobs_db().execute(
+        "UPDATE jobs SET state = 'queued' WHERE state = 'running' AND worker = ?", (worker_id,)
+    )
+    if cursor.rowcount:
+        op_logger.info(f"Resuming {cursor.rowcount} jobs from the journal")
+
+def journal_prune():
+    get_jobs_db().execute(
+        "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated < ?", (time.time() - 7 * 86400,)
+    )
+
+def resume_jobs():
+    """Put jobs interrupted by a restart back on the queues, running ones first."""
+    journal_prune()
+    resumed = 0
+    for job in journal_unfinished():
+        state = users.touch(job["user_id"], force=True)
+        if not state.queue:
+            user_rotation.append(job["user_id"])
+        state.queue.append((job["id"], job["link"]))
+        resumed += 1
+    if resumed:
+        op_logger.info(f"Resuming {resumed} jobs from the journal")
+
+class UserState:
+    """What the scheduler needs to know about one user; ids only, never Message objects."""
+    __slots__ = ("queue", "active_tasks", "status_message_id", "last_seen")
+
+    def __init__(self):
+        self.queue = deque()  # (job_id, link)
+        self.active_tasks = 0
+        self.status_message_id = None  # Status message of the user's current job
+        self.last_seen = time.monotonic()
+
+    def idle(self):
+        return not self.queue and not self.active_tasks
+
+class UserStore:
+    """Per-user state in least-recently-seen order, bounded by USER_STATE_TTL and USER_STATE_MAX."""
+
+    def __init__(self, ttl, max_users):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._states = OrderedDict()
+
+    def __len__(self):
+        return len(self._states)
+
+    def items(self):
+        return list(self._states.items())
+
+    def peek(self, user_id):
+        return self._states.get(user_id)
+
+    def touch(self, user_id, force=False):
+        """Return the user's state, creating it if needed; None if the store is full of busy users."""
+        state = self._states.get(user_id)
+        if state is not None:
+            self._states.move_to_end(user_id)
+        else:
+            self.evict()
+            if len(self._states) >= self.max_users and not force:
+                return None
+            state = self._states[user_id] = UserState()
+        state.last_seen = time.monotonic()
+        return state
+
+    def evict(self):
+        """Drop idle users that expired, then idle users in LRU order while over the cap."""
+        now = time.monotonic()
+        for user_id, state in list(self._states.items()):
+            expired = now - state.last_seen > self.ttl
+            if not expired and len(self._states) < self.max_users:
+                break
+            if state.idle():
+                del self._states[user_id]
+
+file_pickers = {}  # token -> pending file selection
+users = UserStore(USER_STATE_TTL, USER_STATE_MAX)
+user_rotation = deque()  # Users with queued links, in round-robin order
+running_jobs = set()
+infohash_jobs = {}  # infohash -> set once the job fetching it ends
+scheduler_wakeup = asyncio.Event()
+upload_slots = asyncio.Semaphore(UPLOAD_WORKERS)
+media_slots = asyncio.Semaphore(MEDIA_WORKERS)
 
 @bot.on_message(filters.command("start") & (filters.private | filters.group))
 async def start_handler(client, message):
@@ -203,132 +1371,884 @@ async def start_handler(client, message):
         "<b>How to use:</b>\n"
         "Send a magnet link, .torrent URL, or .torrent file.\n"
         "I'll download and upload the files in order!\n"
-        "<b>Note:</b> Only one task per user at a time.\n"
+        f"<b>Note:</b> Your links are processed one at a time (up to {MAX_QUEUED_PER_USER} queued).\n"
     )
     await message.reply(caption)
 
-async def run_aria2c(command, msg, start_time, torrent_name):
-    global aria_processes
-    kill_aria_processes()
-    user_id = msg.chat.id
-    msg_id = msg.id
+def start_aria2_daemon():
+    """Start the shared aria2c RPC daemon if it is not already running."""
+    # Callers that arrive while another thread is starting it wait until RPC answers
+    with aria2_start_lock:
+        return _start_aria2_daemon()
+
+def _start_aria2_daemon():
+    global aria2_process
+    if aria2_process and aria2_process.poll() is None:
+        return True
+
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    os.makedirs(ARIA2_STATE_DIR, exist_ok=True)
+    session_file = os.path.join(ARIA2_STATE_DIR, "session.txt")
+    cmd = [
+        "aria2c",
+        "--enable-rpc=true",
+        "--rpc-listen-all=false",
+        f"--rpc-listen-port={ARIA2_RPC_PORT}",
+        f"--rpc-secret={ARIA2_RPC_SECRET}",
+        "--rpc-max-request-size=16M",
+        f"--stop-with-process={os.getpid()}",
+        "--enable-color=false",
+        "--console-log-level=warn",
+        "--log-level=warn",
+        "--allow-overwrite=true",
+        "--continue=true",
+        "--check-certificate=false",
+        "--auto-file-renaming=true",
+        "--file-allocation=none",
+        f"--disk-cache={disk_cache_size()}",
+        "--enable-dht=true",
+        "--enable-dht6=true",
+        f"--dht-file-path={os.path.join(ARIA2_STATE_DIR, 'dht.dat')}",
+        f"--dht-file-path6={os.path.join(ARIA2_STATE_DIR, 'dht6.dat')}",
+        f"--dht-entry-point={DHT_ENTRY_POINT}",
+        f"--dht-entry-point6={DHT_ENTRY_POINT}",
+        f"--save-session={session_file}",
+        "--save-session-interval=60",
+        "--bt-enable-lpd=true",
+        "--bt-save-metadata=true",
+        "--seed-time=0",
+        "--max-connection-per-server=16",
+        "--split=16",
+        f"--max-concurrent-downloads={ARIA2_MAX_CONCURRENT}",
+        f"--max-overall-download-limit={MAX_TOTAL_BANDWIDTH}",
+        "--max-download-result=1000",
+        f"--dir={os.path.abspath(DOWNLOAD_DIR)}",
+    ]
+    if os.path.isfile(session_file):
+        cmd.append(f"--input-file={session_file}")
+    op_logger.info("Starting aria2 RPC daemon")
+    aria2_process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        if aria2_process.poll() is not None:
+            break
+        try:
+            aria2_client.get_version()
+        except Exception:
+            time.sleep(0.2)
+            continue
+        discard_orphan_downloads()
+        return True
+    op_logger.error("aria2 RPC daemon failed to start")
+    if aria2_process.poll() is None:
+        aria2_process.kill()  # So the next call starts a fresh one instead of trusting it
+        aria2_process.wait()
+    return False
+
+def disk_cache_size():
+    """aria2 write cache sized to the memory this host can spare: 1/64 of it, 16-256 MiB."""
+    available = psutil.virtual_memory().available
+    return max(16, min(256, available // (64 * 1024 * 1024))) * 1024 * 1024
+
+@functools.lru_cache(maxsize=1)
+def file_allocation_mode():
+    """falloc where the download filesystem can reserve space cheaply, else none."""
+    path = os.path.abspath(DOWNLOAD_DIR)
+    best = None
+    try:
+        for partition in psutil.disk_partitions(all=True):
+            mount = partition.mountpoint
+            if path == mount or path.startswith(mount.rstrip("/") + "/"):
+                if best is None or len(mount) > len(best.mountpoint):
+                    best = partition
+    except Exception as e:
+        op_logger.error(f"Could not detect the download filesystem: {str(e)}")
+    return "falloc" if best and best.fstype in FALLOC_FILESYSTEMS else "none"
+
+def tune_profile(downloads, total_bandwidth, available_memory, ramping=()):
+    """Per-download bt-max-peers and max-download-limit for the downloads running right now.
+
+    GIDs in `ramping` started or resumed recently; their speed is not meaningful yet, so they stay uncapped.
+    """
+    if not downloads:
+        return {}
+    # The peer budget shrinks when memory runs low
+    memory_factor = max(0.25, min(1.0, available_memory / (1024 * 1024 * 1024)))
+    peers = max(20, min(150, int(ARIA2_PEER_BUDGET * memory_factor / len(downloads))))
+    caps = dict.fromkeys(downloads, 0)
+    if total_bandwidth and len(downloads) > 1:  # A lone download gets the whole budget
+        # Swarms that cannot use their fair share keep what they use plus headroom;
+        # the rest of the cap is split among the others
+        remaining = total_bandwidth
+        sharing = len(downloads)
+        pending = sorted((item for item in downloads.items() if item[0] not in ramping), key=lambda item: item[1])
+        while pending:
+            gid, speed = pending[0]
+            fair = remaining / sharing
+            if speed * 1.25 >= fair:
+                break
+            caps[gid] = max(64 * 1024, int(speed * 1.25))
+            remaining -= caps[gid]
+            sharing -= 1
+            pending.pop(0)
+        for gid, _ in pending:
+            caps[gid] = max(64 * 1024, int(remaining / sharing))
+    return {gid: {"bt-max-peers": str(peers), "max-download-limit": str(caps[gid])} for gid in downloads}
+
+def needs_retune(applied, wanted):
+    """Skip changes under 20% so the daemon is not poked every interval."""
+    if applied is None or applied["bt-max-peers"] != wanted["bt-max-peers"]:
+        return True
+    old, new = int(applied["max-download-limit"]), int(wanted["max-download-limit"])
+    if not old or not new:
+        return old != new
+    return abs(new - old) > 0.2 * old
+
+async def aria2_tuner():
+    """Adjust running downloads live; these options apply without restarting them."""
+    applied = {}
+    first_seen = {}  # gid -> when it was last seen becoming active
+    while True:
+        await asyncio.sleep(ARIA2_TUNE_INTERVAL)
+        if not (aria2_process and aria2_process.poll() is None):
+            continue
+        try:
+            active = await aria2_call("tell_active", ["gid", "downloadSpeed", "bittorrent"])
+            downloads = {d["gid"]: int(d["downloadSpeed"]) for d in active if "bittorrent" in d}
+            now = time.monotonic()
+            # A paused download drops out of tell_active, so it ramps up again once resumed
+            for gid in set(first_seen) - set(downloads):
+                del first_seen[gid]
+            ramping = {gid for gid in downloads if now - first_seen.setdefault(gid, now) < ARIA2_RAMP_UP}
+            profile = tune_profile(downloads, MAX_TOTAL_BANDWIDTH, psutil.virtual_memory().available, ramping)
+            for gid, options in profile.items():
+                if needs_retune(applied.get(gid), options):
+                    await aria2_call("change_option", gid, options)
+                    applied[gid] = options
+                    metric_inc("aria2_retunes_total")
+            for gid in set(applied) - set(profile):
+                del applied[gid]
+        except Exception as e:
+            op_logger.error(f"aria2 tuning error: {str(e)}")
+
+def discard_orphan_downloads():
+    """Drop downloads restored from the aria2 session that no unfinished job owns any more."""
+    try:
+        owned = {job["gid"] for job in journal_unfinished() if job["gid"]}
+        downloads = aria2_client.tell_active(["gid"]) + aria2_client.tell_waiting(0, 1000, ["gid"])
+        for download in downloads:
+            if download["gid"] not in owned:
+                aria2_client.force_remove(download["gid"])
+    except Exception as e:
+        op_logger.error(f"Could not clean up restored aria2 downloads: {str(e)}")
+
+def lookup_metadata(infohash):
+    """Return the saved .torrent for an infohash, if a magnet for it was resolved before."""
+    path = os.path.join(METADATA_DIR, f"{infohash}.torrent")
+    try:
+        os.utime(path)  # Keeps it from expiring while it is in use
+        return path
+    except FileNotFoundError:
+        return None
+
+def save_metadata(infohash, directory):
+    """Keep the .torrent aria2 wrote for a magnet (--bt-save-metadata) past the job's cleanup."""
+    saved = os.path.join(directory, f"{infohash}.torrent")
+    if os.path.isfile(saved):
+        os.makedirs(METADATA_DIR, exist_ok=True)
+        shutil.copyfile(saved, os.path.join(METADATA_DIR, f"{infohash}.torrent"))
+
+def bdecode(data, pos=0):
+    """Decode one bencoded value starting at pos; returns (value, end)."""
+    kind = data[pos:pos + 1]
+    if kind == b"i":
+        end = data.index(b"e", pos)
+        return int(data[pos + 1:end]), end + 1
+    if kind in (b"l", b"d"):
+        items, pos = [], pos + 1
+        while data[pos:pos + 1] != b"e":
+            item, pos = bdecode(data, pos)
+            items.append(item)
+        return (dict(zip(items[::2], items[1::2])) if kind == b"d" else items), pos + 1
+    colon = data.index(b":", pos)
+    end = colon + 1 + int(data[pos:colon])
+    return data[colon + 1:end], end
+
+def torrent_size(path):
+    """Total size of a .torrent's files, or None if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            info = bdecode(f.read())[0][b"info"]
+        if b"files" in info:
+            return sum(entry[b"length"] for entry in info[b"files"])
+        return info[b"length"]
+    except (OSError, ValueError, IndexError, KeyError, TypeError):
+        return None
+
+def torrent_infohash(path):
+    """SHA-1 infohash of a .torrent file as aria2 reports it, or None if it cannot be read."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:1] != b"d":
+            return None
+        pos = 1
+        while data[pos:pos + 1] != b"e":
+            key, pos = bdecode(data, pos)
+            start = pos
+            _, pos = bdecode(data, pos)
+            if key == b"info":
+                return hashlib.sha1(data[start:pos]).hexdigest()
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def estimate_job_size(link):
+    """Size of a job before it starts, when its metadata is already on disk."""
+    if link.startswith("magnet:?"):
+        infohash = magnet_infohash(link)
+        return torrent_size(os.path.join(METADATA_DIR, f"{infohash}.torrent")) if infohash else None
+    if not re.match(r"^https?://", link, re.IGNORECASE):
+        return torrent_size(link)
+    return None
+
+async def aria2_call(method, *args):
+    """Run a blocking aria2 RPC call without stalling the event loop."""
+    return await asyncio.to_thread(getattr(aria2_client, method), *args)
+
+async def add_aria2_download(link, options):
+    if not await asyncio.to_thread(start_aria2_daemon):
+        raise RuntimeError("aria2 daemon is not available")
+    if not link.startswith("magnet:?") and os.path.isfile(link):
+        with open(link, "rb") as f:
+            encoded = base64.b64encode(f.read()).decode()
+        return await aria2_call("add_torrent", encoded, [], options)
+    return await aria2_call("add_uri", [link], options)
+
+async def discard_aria2_download(gid, force=False):
+    try:
+        if force:
+            await aria2_call("force_remove", gid)
+    except Exception:
+        pass
+    try:
+        await aria2_call("remove_download_result", gid)
+    except Exception:
+        pass
+
+def pick_uploadable_files(aria2_files):
+    """Turn aria2 file entries into (path, complete, index, length) tuples in delivery order."""
+    result = []
+    for entry in aria2_files:
+        if entry.get("selected") == "false":
+            continue
+        path = Path(entry["path"])
+        length = int(entry["length"])
+        if length <= 1024 or path.suffix.lower() in ('.aria2', '.tmp', '.torrent'):
+            continue
+        result.append((path, int(entry["completedLength"]) >= length, int(entry["index"]), length))
+    result.sort(key=lambda x: natural_sort_key(x[0].name))
+    return result
+
+async def drop_aria2_download(gid):
+    """Remove a download restored from the aria2 session; its files and control file stay."""
+    while gid:
+        try:
+            status = await aria2_call("tell_status", gid, ["status", "followedBy"])
+            if status["status"] in ("active", "waiting", "paused"):
+                await aria2_call("force_remove", gid)
+                # The infohash stays registered, so re-adding it fails, until the removal is done
+                for _ in range(50):
+                    await asyncio.sleep(0.1)
+                    if (await aria2_call("tell_status", gid, ["status"]))["status"] == "removed":
+                        break
+        except Exception:
+            return
+        await discard_aria2_download(gid)
+        gid = (status.get("followedBy") or [None])[0]
+
+async def claim_infohash(infohash, msg, torrent_name):
+    """Wait until no other job is fetching this torrent; aria2 rejects a second copy of it."""
+    while infohash in infohash_jobs:
+        post_progress(msg, f"⏳ **Waiting for another download of this torrent...**\n🪺 Torrent: `{torrent_name}`\n")
+        await infohash_jobs[infohash].wait()
+    infohash_jobs[infohash] = asyncio.Event()
+
+def release_infohash(infohash):
+    event = infohash_jobs.pop(infohash, None)
+    if event:
+        event.set()
+
+def is_superseded(msg):
+    """True once the user's status message points at a newer job than msg's."""
+    state = users.peek(msg.chat.id)
+    return state is not None and state.status_message_id not in (None, msg.id)
+
+async def wait_for_metadata(gid, msg, start_time, torrent_name):
+    """Follow a paused download until its file list is known; returns the content GID."""
+    while True:
+        if is_superseded(msg):
+            await discard_aria2_download(gid, force=True)
+            return None
+        if time.time() - start_time > TIMEOUT:
+            await discard_aria2_download(gid, force=True)
+            return None
+
+        status = await aria2_call("tell_status", gid, ["status", "followedBy", "errorMessage"])
+        if status.get("followedBy"):
+            await discard_aria2_download(gid)
+            gid = status["followedBy"][0]
+            continue
+        if status["status"] in ("paused", "complete"):
+            return gid
+        if status["status"] in ("error", "removed"):
+            op_logger.error(f"aria2 metadata {gid} failed: {status.get('errorMessage', status['status'])}")
+            await discard_aria2_download(gid)
+            return None
+
+        post_progress(msg, f"🧲 **Fetching metadata...**\n🪺 Torrent: `{torrent_name}`\n")
+        await asyncio.sleep(ARIA2_POLL_INTERVAL)
+
+def parse_selection(text):
+    return [int(i) for i in text.split(",")] if text else []
+
+def auto_select_files(aria2_files):
+    """Apply the extension, size and name filters; falls back to everything if nothing is left."""
+    selected = []
+    for entry in aria2_files:
+        name = os.path.basename(entry["path"])
+        if int(entry["length"]) < MIN_FILE_SIZE:
+            continue
+        if os.path.splitext(name)[1].lower() in AUTO_SKIP_EXTENSIONS:
+            continue
+        if AUTO_SKIP_PATTERN and re.search(AUTO_SKIP_PATTERN, name):
+            continue
+        selected.append(int(entry["index"]))
+    return selected or [int(entry["index"]) for entry in aria2_files]
+
+async def choose_files(msg, user_id, torrent_name, aria2_files):
+    """Pick the file indices to download. Returns (selected, auto_selected)."""
+    auto_selected = auto_select_files(aria2_files)
+    selected = auto_selected
+    # Workers get no updates, so they cannot see the picker's button presses
+    if FILE_PICKER and ROLE != "worker" and len(aria2_files) > 1:
+        selected = await run_file_picker(msg, user_id, torrent_name, aria2_files, auto_selected)
+    return sorted(selected), sorted(auto_selected)
+
+def disk_reserved():
+    """Bytes that running batches will still write, which disk usage does not show yet."""
+    if file_allocation_mode() == "falloc":
+        return 0  # aria2 claims the whole batch up front
+    return sum(max(0, stats["reserved"] - stats["downloaded"]) for stats in list(job_stats.values()))
+
+def disk_budget():
+    """Bytes that can still be written to the download volume before its high-water mark."""
+    usage = psutil.disk_usage(DOWNLOAD_DIR)
+    return min(int(usage.total * DISK_HIGH_WATER) - usage.used, usage.free - MIN_FREE_DISK) - disk_reserved()
+
+def take_stream_batch(pending, budget):
+    """Take files in order while they fit the budget, always at least one so the job moves on."""
+    batch, size = [], 0
+    for entry in pending:
+        size += int(entry["length"])
+        if batch and size > budget:
+            break
+        batch.append(entry)
+    return batch
 
-    process = await asyncio.create_subprocess_exec(
-        *command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT
+def next_stream_batch(stream_files, budget, stats):
+    """Take the next batch off stream_files and reserve its size until aria2 has written it."""
+    batch = take_stream_batch(stream_files, budget)
+    del stream_files[:len(batch)]
+    stats.update(
+        reserved=sum(int(f["length"]) for f in batch),
+        downloaded=0,
+        backlog=sum(int(f["length"]) for f in stream_files),
     )
-    aria_processes.append(process)
-    
-    progress_regex = re.compile(
-        r'\[#\w+\s+([\d.]+\w*)/([\d.]+\w*)\((\d+)%\)\s+.*DL:([\d.]+\w*).*ETA:(\w+)\]'
+    return batch
+
+def render_file_picker(token):
+    picker = file_pickers[token]
+    files = picker["files"]
+    selected = picker["selected"]
+    pages = max(1, math.ceil(len(files) / FILE_PICKER_PAGE_SIZE))
+    page = picker["page"] = max(0, min(picker["page"], pages - 1))
+    selected_size = sum(f["size"] for f in files if f["index"] in selected)
+
+    rows = []
+    for f in files[page * FILE_PICKER_PAGE_SIZE:(page + 1) * FILE_PICKER_PAGE_SIZE]:
+        mark = "✅" if f["index"] in selected else "⬜"
+        label = f"{mark} {f['name'][:40]} ({human_readable_size(f['size'], 1)})"
+        rows.append([InlineKeyboardButton(label, callback_data=f"pick:{token}:t:{f['index']}")])
+    nav = [InlineKeyboardButton("All", callback_data=f"pick:{token}:a"),
+           InlineKeyboardButton("None", callback_data=f"pick:{token}:n")]
+    if pages > 1:
+        nav.insert(0, InlineKeyboardButton("◀️", callback_data=f"pick:{token}:p:{page - 1}"))
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"pick:{token}:p:{page + 1}"))
+    rows.append(nav)
+    rows.append([InlineKeyboardButton(f"⬇️ Download {len(selected)} files", callback_data=f"pick:{token}:go")])
+
+    text = (
+        f"🗂 **Select files**\n"
+        f"🪺 Torrent: `{picker['name']}`\n"
+        f"📦 Selected: {len(selected)}/{len(files)} ({human_readable_size(selected_size)})\n"
+        f"📄 Page {page + 1}/{pages} | ⏳ Starts automatically in {FILE_PICKER_TIMEOUT}s\n"
+    )
+    return text, InlineKeyboardMarkup(rows)
+
+async def show_file_picker(msg, token):
+    text, markup = render_file_picker(token)
+    # A queued progress edit carries no keyboard and would wipe the picker when it goes out
+    key = (msg.chat.id, msg.id)
+    pending_edits.pop(key, None)
+    last_edit_at[key] = time.time()
+    try:
+        await with_flood_retry(msg.edit_text, text, reply_markup=markup, source="picker")
+    except (MessageNotModified, MessageIdInvalid):
+        pass
+    except Exception as e:
+        op_logger.error(f"Error showing file picker: {str(e)}")
+
+async def run_file_picker(msg, user_id, torrent_name, aria2_files, preselected):
+    files = sorted(
+        ({"index": int(f["index"]), "name": os.path.basename(f["path"]), "size": int(f["length"])}
+         for f in aria2_files),
+        key=lambda f: natural_sort_key(f["name"])
     )
-    last_update = time.time()
-    last_reported_percent = -1
+    token = secrets.token_hex(4)
+    file_pickers[token] = {
+        "user_id": user_id,
+        "name": torrent_name,
+        "files": files,
+        "selected": set(preselected),
+        "page": 0,
+        "done": asyncio.Event(),
+    }
+    try:
+        await show_file_picker(msg, token)
+        try:
+            await asyncio.wait_for(file_pickers[token]["done"].wait(), FILE_PICKER_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        return file_pickers[token]["selected"] or set(preselected)
+    finally:
+        file_pickers.pop(token, None)
+
+async def run_aria2_download(gid, msg, start_time, torrent_name, on_files=None, on_gid=None, stats=None):
+    try:
+        return await watch_aria2_download(gid, msg, start_time, torrent_name, on_files, on_gid, stats)
+    except asyncio.CancelledError:
+        await discard_aria2_download(gid, force=True)
+        raise
+    finally:
+        if stats is not None:
+            stats["downloading"] = False
+
+async def watch_aria2_download(gid, msg, start_time, torrent_name, on_files, on_gid, stats):
+    stats = stats if stats is not None else {}
+    if stats.get("phase") != "download":
+        stats["phase"] = "metadata"
+    phase_started = time.monotonic()
+    keys = ["status", "totalLength", "completedLength", "downloadSpeed",
+            "followedBy", "errorCode", "errorMessage"]
+    if on_files:
+        keys.append("files")
+    paused_since = None
 
     while True:
-        if user_id in active_downloads and active_downloads[user_id] != msg_id:
-            process.terminate()
+        if is_superseded(msg):
+            await discard_aria2_download(gid, force=True)
             return False
 
-        elapsed = time.time() - start_time
+        # Time spent paused for smaller jobs does not count towards the timeout
+        elapsed = (paused_since or time.time()) - start_time
         if elapsed > TIMEOUT:
-            process.terminate()
+            await discard_aria2_download(gid, force=True)
             await safe_edit_message(msg, "❌ Download timed out after 30 minutes!")
             return False
 
         try:
-            line = await asyncio.wait_for(process.stdout.readline(), 1.0)
-        except asyncio.TimeoutError:
-            if process.returncode is not None:
-                break
-            continue
+            status = await aria2_call("tell_status", gid, keys)
+        except Exception as e:
+            op_logger.error(f"aria2 status error for {gid}: {str(e)}")
+            await discard_aria2_download(gid, force=True)
+            return False
 
-        if not line:
-            if process.returncode is not None:
-                break
+        # A magnet first resolves metadata, then aria2 continues in a new GID
+        if status.get("followedBy"):
+            await discard_aria2_download(gid)
+            gid = status["followedBy"][0]
+            if on_gid:
+                on_gid(gid)
             continue
 
-        line = line.decode().strip()
-        op_logger.debug(f"aria2c: {line}")
+        total = int(status.get("totalLength", 0))
+        downloaded = int(status.get("completedLength", 0))
+        speed = int(status.get("downloadSpeed", 0))
+        stats.update(gid=gid, total=total, downloaded=downloaded, download_speed=speed, downloading=bool(total))
+        if total and stats["phase"] == "metadata":
+            observe_phase("metadata", time.monotonic() - phase_started)
+            stats["phase"] = "download"
+            phase_started = time.monotonic()
 
-        if "Download complete:" in line:
+        files = status.get("files") or []
+        if on_files and total and not any(f["path"].startswith("[METADATA]") for f in files):
+            on_files(files)
+
+        state = status["status"]
+        if state == "complete":
+            observe_phase("download", time.monotonic() - phase_started)
+            stats.update(phase="upload", download_speed=0)
+            await discard_aria2_download(gid)
             return True
+        if state in ("error", "removed"):
+            op_logger.error(f"aria2 download {gid} failed: {status.get('errorMessage', state)}")
+            await discard_aria2_download(gid)
+            return False
+        if state == "paused":
+            paused_since = paused_since or time.time()
+        elif paused_since:
+            start_time += time.time() - paused_since
+            paused_since = None
 
-        match = progress_regex.search(line)
-        if match:
-            downloaded = match.group(1)
-            total = match.group(2)
-            percentage = int(match.group(3))
-            speed = match.group(4)
-            eta = match.group(5)
-
-            if time.time() - last_update > 5 or percentage == 100:
-                bar = progress_bar(percentage)
-                status = (
-                    f"📩 **Downloading...**\n"
-                    f"🪺 Torrent: `{torrent_name}`\n"
-                    f"📦 Progress: {downloaded}/{total} ({percentage}%)\n"
-                    f"🔸 {bar} 🔸\n"
-                    f"🚀 Speed: {speed} | ⏳ ETA: {eta}\n"
-                )
-                await safe_edit_message(msg, status)
-                last_update = time.time()
-                last_reported_percent = percentage
-
-    return await process.wait() == 0
-
-async def process_torrent(user_id, link, msg):
-    timestamp = int(time.time())
-    USER_DIR = Path(DOWNLOAD_DIR) / f"user_{user_id}_{timestamp}"
-    USER_DIR.mkdir(parents=True, exist_ok=True)
-
-    extra_trackers = [
-        "udp://tracker.openbittorrent.com:80",
-        "udp://tracker.opentrackr.org:1337",
-        "udp://9.rarbg.me:2710",
-        "udp://9.rarbg.to:2710",
-        "udp://tracker.tiny-vps.com:6969",
-        "udp://open.demonii.com:1337/announce",
-        "udp://tracker.internetwarriors.net:1337",
-        "udp://tracker.leechers-paradise.org:6969/announce",
-        "udp://exodus.desync.com:6969",
-        "udp://tracker.moeking.me:6969",
-        "udp://tracker.dler.org:6969",
-        "udp://tracker.filemail.com:6969",
-        "udp://public.popcorn-tracker.org:6969",
-        "udp://explodie.org:6969",
-        "udp://tracker.torrent.eu.org:451",
-        "udp://tracker.cyberia.is:6969",
-        "udp://p4p.arenabg.com:1337",
-        "udp://tracker.bt4g.com:6969/announce",
-        "udp://tracker4.itzmx.com:2710/announce",
-        "udp://tracker.ccc.de:80",
-        "udp://denis.stalker.upeer.me:6969/announce"
-    ]
+        if paused_since and total:
+            status_text = (
+                f"⏸️ **Paused for smaller downloads...**\n"
+                f"🪺 Torrent: `{torrent_name}`\n"
+                f"📦 Progress: {human_readable_size(downloaded)}/{human_readable_size(total)} ({downloaded * 100 // total}%)\n"
+            )
+        elif total:
+            percentage = downloaded * 100 // total
+            eta = time_formatter((total - downloaded) / speed) if speed else "∞"
+            status_text = (
+                f"📩 **Downloading...**\n"
+                f"🪺 Torrent: `{torrent_name}`\n"
+                f"📦 Progress: {human_readable_size(downloaded)}/{human_readable_size(total)} ({percentage}%)\n"
+                f"🔸 {progress_bar(percentage)} 🔸\n"
+                f"🚀 Speed: {human_readable_size(speed)}/s | ⏳ ETA: {eta}\n"
+            )
+        else:
+            status_text = (
+                f"🧲 **Fetching metadata...**\n"
+                f"🪺 Torrent: `{torrent_name}`\n"
+            )
+        post_progress(msg, status_text)
+
+        await asyncio.sleep(ARIA2_POLL_INTERVAL)
+
+async def with_flood_retry(func, *args, source="upload", **kwargs):
+    """Await a Telegram call, backing off on FloodWait instead of failing it."""
+    for _ in range(FLOOD_RETRIES):
+        try:
+            return await func(*args, **kwargs)
+        except FloodWait as e:
+            op_logger.warning(f"FloodWait: sleeping {e.value}s")
+            metric_inc("floodwait_total", source=source)
+            metric_inc("floodwait_seconds_total", e.value, source=source)
+            await asyncio.sleep(e.value + 1)
+    return await func(*args, **kwargs)
+
+def media_caption(mime, filename):
+    for prefix, icon in (("video", "🎬"), ("audio", "🎵"), ("image", "🖼️")):
+        if mime.startswith(prefix):
+            return f"{icon} {filename}"
+    return f"📦 {filename}"
+
+async def prepare_upload(msg, file_path, offset, part_size, part_name, total_parts, stats=None, reuse=True):
+    """Upload the bytes of one file part; returns the media, the caption and its content identity."""
+    filename = file_path.name
+    if total_parts > 1:
+        mime = "application/octet-stream"
+    else:
+        mime, _ = mimetypes.guess_type(str(file_path))
+        mime = mime or "application/octet-stream"
+
+    content = None
+    if DEDUPE_UPLOADS:
+        fingerprint = await run_fs(content_fingerprint, str(file_path), offset, part_size)
+        file_id, digest = dedupe_lookup(fingerprint) if reuse else (None, None)
+        # The samples only find candidates; reading the whole part is still far cheaper than uploading it
+        if file_id and await run_fs(content_digest, str(file_path), offset, part_size) != digest:
+            metric_inc("dedupe_collisions_total")
+            file_id = None
+        if file_id:
+            metric_inc("dedupe_hits_total")
+            metric_inc("dedupe_bytes_total", part_size)
+            content = {"fingerprint": fingerprint, "reused": True}
+            return get_input_media_from_file_id(file_id), media_caption(mime, filename), content
+        content = {"fingerprint": fingerprint, "reused": False}
+
+    # Probe before taking an upload slot so the uplink is never idle waiting on ffmpeg
+    info = None
+    thumbnail = None
+    with phase_timer("probe"):
+        if mime.startswith("video"):
+            info, thumbnail = await asyncio.gather(
+                probe_media(str(file_path)), extract_thumbnail(str(file_path))
+            )
+        elif mime.startswith("audio"):
+            info = await probe_media(str(file_path))
+
+    try:
+        async with upload_slots:
+            with phase_timer("upload", stats):
+                # Parts are streamed straight from the original file, hashed on the way out
+                part = FileSlice(str(file_path), offset, part_size, part_name)
+                if content:
+                    part = HashingReader(part, part_size)
+
+                progress = create_upload_callback(msg, part_name, stats)
+                try:
+                    if mime.startswith("video"):
+                        thumb = await with_flood_retry(bot.save_file, thumbnail) if thumbnail else None
+                        file = await with_flood_retry(bot.save_file, part, progress=progress)
+                        media = raw.types.InputMediaUploadedDocument(
+                            mime_type=mime,
+                            file=file,
+                            thumb=thumb,
+                            attributes=[
+                                raw.types.DocumentAttributeVideo(
+                                    supports_streaming=True,
+                                    duration=info["duration"],
+                                    w=info["width"],
+                                    h=info["height"]
+                                ),
+                                raw.types.DocumentAttributeFilename(file_name=part_name)
+                            ]
+                        )
+                        return media, media_caption(mime, filename), content
+                    if mime.startswith("audio"):
+                        file = await with_flood_retry(bot.save_file, part, progress=progress)
+                        media = raw.types.InputMediaUploadedDocument(
+                            mime_type=mime,
+                            file=file,
+                            attributes=[
+                                raw.types.DocumentAttributeAudio(duration=info["duration"]),
+                                raw.types.DocumentAttributeFilename(file_name=part_name)
+                            ]
+                        )
+                        return media, media_caption(mime, filename), content
+                    if mime.startswith("image"):
+                        file = await with_flood_retry(bot.save_file, part, progress=progress)
+                        media = raw.types.InputMediaUploadedPhoto(file=file)
+                        return media, media_caption(mime, filename), content
+
+                    file = await with_flood_retry(bot.save_file, part, progress=progress)
+                    media = raw.types.InputMediaUploadedDocument(
+                        mime_type=mime,
+                        file=file,
+                        attributes=[raw.types.DocumentAttributeFilename(file_name=part_name)]
+                    )
+                    return media, media_caption(mime, filename), content
+                finally:
+                    if content:
+                        content["digest"] = part.hexdigest()
+                    part.close()
+    finally:
+        if thumbnail:
+            await run_fs(remove_path, thumbnail)
+
+async def prepare_archive_upload(msg, members, name, stats=None):
+    """Upload a tar volume of (path, arcname) members as it is generated."""
+    async with upload_slots:
+        with phase_timer("upload", stats):
+            archive = await run_fs(TarStream, members, name)
+            try:
+                progress = create_upload_callback(msg, name, stats)
+                file = await with_flood_retry(bot.save_file, archive, progress=progress)
+            finally:
+                archive.close()
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type="application/x-tar",
+        file=file,
+        attributes=[raw.types.DocumentAttributeFilename(file_name=name)]
+    )
+    return media, f"🗜️ {name} ({len(members)} files)", None
+
+async def send_prepared(msg, media, caption):
+    """Send already-uploaded media to the job's chat and return the resulting Message."""
+    rpc = raw.functions.messages.SendMedia(
+        peer=await bot.resolve_peer(msg.chat.id),
+        media=media,
+        message=caption,
+        random_id=bot.rnd_id()
+    )
+    r = await with_flood_retry(bot.invoke, rpc)
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await Message._parse(
+                bot, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+    return None
+
+class OrderedUploader:
+    """Uploads parts on a bounded worker pool but sends the messages in submission order."""
+
+    def __init__(self, msg, infohash=None, job_id=None, done_parts=(), stats=None, cacheable=False):
+        self.msg = msg
+        self.stats = stats
+        self.infohash = infohash
+        self.cacheable = cacheable  # Only jobs that called cache_begin may add to the result cache
+        self.job_id = job_id
+        self.done_parts = set(done_parts)
+        self.sent = 0
+        self.failed = 0
+        self._failed_files = set()
+        self._queue = asyncio.Queue(maxsize=UPLOAD_WORKERS * 2)
+        self._tasks = set()
+        self._sender = asyncio.create_task(self._send_loop())
+
+    async def submit(self, file_path, file_index=0):
+        size = await run_fs(file_size, file_path)
+        if size is None:
+            op_logger.error(f"Downloaded file is missing: {file_path}")
+            return
+        if size > MAX_SIZE:
+            with phase_timer("split"):
+                file_parts = await run_fs(split_large_file, str(file_path))
+        else:
+            file_parts = [(0, size, file_path.name)]
+
+        total_parts = len(file_parts)
+        if (file_index, 0) in self.done_parts:
+            await run_fs(remove_path, file_path)
+            return
+        for part_index, (offset, part_size, part_name) in enumerate(file_parts, 1):
+            if (file_index, part_index) in self.done_parts:
+                continue
+            upload = functools.partial(
+                prepare_upload, self.msg, file_path, offset, part_size, part_name, total_parts, self.stats
+            )
+            task = asyncio.create_task(upload())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            await self._queue.put((task, file_path, file_index, part_index, total_parts, (), upload))
+
+    async def submit_archive(self, files, base_name, root):
+        """Send (path, file_index) files as tar volumes instead of one message per file."""
+        members = []
+        for file_path, file_index in files:
+            if (file_index, 0) in self.done_parts:
+                await run_fs(remove_path, file_path)
+            else:
+                members.append((file_path, file_index))
+        if not members:
+            return
+        volumes = await run_fs(plan_archive_volumes, members, str(root))
+        for number, volume in enumerate(volumes, 1):
+            name = f"{base_name}.tar" if len(volumes) == 1 else f"{base_name}.part{number:03d}.tar"
+            metric_inc("archive_volumes_total")
+            task = asyncio.create_task(prepare_archive_upload(
+                self.msg, [(path, arcname) for path, arcname, _ in volume], name, self.stats
+            ))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            packed = tuple((path, file_index) for path, _, file_index in volume)
+            await self._queue.put((task, Path(name), volume[0][2], 1, 1, packed, None))
+
+    async def _send_loop(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            task, file_path, file_index, part_index, total_parts, packed, upload = item
+            try:
+                media, caption, content = await task
+                try:
+                    message = await send_prepared(self.msg, media, caption)
+                except Exception as e:
+                    if not (content and content["reused"]):
+                        raise
+                    # The stored file_id stopped working; upload the bytes after all
+                    op_logger.warning(f"Reusing {file_path.name} failed, uploading it: {str(e)}")
+                    dedupe_forget(content["fingerprint"])
+                    media, caption, content = await upload(reuse=False)
+                    message = await send_prepared(self.msg, media, caption)
+                self.sent += 1
+                journal_part_done(self.job_id, file_index, part_index)
+                if part_index == total_parts and file_path not in self._failed_files:
+                    journal_part_done(self.job_id, file_index, 0)
+                for _, packed_index in packed:
+                    journal_part_done(self.job_id, packed_index, 0)
+                file_id = message_file_id(message)
+                if content and not content["reused"] and content.get("digest") and file_id:
+                    dedupe_record(content["fingerprint"], content["digest"], file_id)
+                if self.infohash and self.cacheable and file_id:
+                    cache_store_file(self.infohash, file_index, part_index, file_path.name, file_id, caption)
+            except Exception as e:
+                self.failed += 1
+                self._failed_files.add(file_path)
+                op_logger.error(f"Upload failed for {file_path.name} part {part_index}: {str(e)}")
+                await safe_edit_message(self.msg, f"❌ Upload failed for {file_path.name}: {str(e)}")
+            finally:
+                if packed:
+                    for packed_path, _ in packed:
+                        await run_fs(remove_path, packed_path)
+                elif part_index == total_parts:
+                    await run_fs(remove_path, file_path)
+                self._queue.task_done()
+
+    async def drain(self):
+        """Wait until every part submitted so far has been sent and its file removed."""
+        await self._queue.join()
+
+    async def close(self):
+        """Wait until every submitted part has been sent."""
+        if not self._sender.done():
+            await self._queue.put(None)
+            await self._sender
+        return self.sent
+
+    async def abort(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._sender.cancel()
+        await asyncio.gather(self._sender, *self._tasks, return_exceptions=True)
+
+async def process_torrent(user_id, link, msg, job_id=None):
+    job = journal_get(job_id)
+    resuming = bool(job and job["dir"])
+    if resuming:
+        USER_DIR = Path(job["dir"])
+        done_parts = journal_parts_done(job_id)
+    else:
+        timestamp = int(time.time())
+        USER_DIR = Path(DOWNLOAD_DIR) / f"user_{user_id}_{timestamp}"
+        journal_update(job_id, dir=str(USER_DIR))
+        done_parts = set()
+    await run_fs(USER_DIR.mkdir, parents=True, exist_ok=True)
 
     start_time = time.time()
     torrent_name = "Unknown"
+    stats_key = job_id or msg.id
+    stats = new_job_stats(stats_key, user_id, torrent_name)
+    infohash = None
+    claimed = None
+    download = None
+    uploader = None
+    interrupted = False
 
     try:
         if link.startswith("magnet:?"):
             torrent_name = get_magnet_name(link)
+            infohash = magnet_infohash(link)
             await safe_edit_message(msg, f"\n📥 Starting download for {torrent_name}...")
-            download_link = link
+            # Skip metadata resolution entirely when this magnet was resolved before
+            download_link = (infohash and await run_fs(lookup_metadata, infohash)) or link
         else:  # .torrent file (URL or local)
             if link.lower().startswith('http'):
                 await safe_edit_message(msg, "📥 Downloading torrent file...")
-                response = requests.get(link, headers={'User-Agent': 'Mozilla/5.0'}, timeout=30)
-                response.raise_for_status()
-                filename = unquote(re.findall(r'filename\*?=[\'"]?(?:UTF-\d[\'"]*)?([^;\'"]+)', 
-                                            response.headers.get("content-disposition", ""), 
-                                            re.IGNORECASE)[0] or os.path.basename(urlparse(link).path))
+                with phase_timer("fetch", stats):
+                    filename, content = await fetch_torrent(link)
                 if not filename.lower().endswith('.torrent'):
                     filename += '.torrent'
                 filename = sanitize_filename(filename)
                 torrent_file_path = USER_DIR / filename
-                with open(torrent_file_path, 'wb') as f:
-                    f.write(response.content)
+                await run_fs(torrent_file_path.write_bytes, content)
                 torrent_name = filename.replace('.torrent', '')
                 download_link = str(torrent_file_path)
             else:  # Local .torrent file
@@ -336,187 +2256,424 @@ async def process_torrent(user_id, link, msg):
                 torrent_name = filename.replace('.torrent', '')
                 download_link = link
                 await safe_edit_message(msg, f"📥 Torrent file ready: {torrent_name}\n🚀 Starting content download...")
+            infohash = await run_fs(torrent_infohash, download_link)
 
-        cmd = [
-            "aria2c",
-            "--console-log-level=info",
-            "--enable-color=false",
-            "--console-log-level=notice",
-            "--log-level=warn",
-            "--allow-overwrite=true",
-            "--check-certificate=false",
-            "--auto-file-renaming=true",
-            "--file-allocation=none",
-            "--enable-dht=true",
-            "--bt-enable-lpd=true",
-            "--bt-save-metadata=true",
-            "--seed-time=0",
-            "--max-connection-per-server=16",
-            "--bt-tracker=" + ",".join(extra_trackers),
-            "--split=16",
-            "--max-concurrent-downloads=5",
-            "--file-allocation=none",
-            "--summary-interval=1",
-            f"--dir={USER_DIR}",
-            download_link
-        ]
+        if infohash:
+            # Another user's job for the same torrent may finish first and fill the cache
+            await claim_infohash(infohash, msg, torrent_name)
+            claimed = infohash
+            if not resuming and await send_from_cache(msg, infohash):
+                return True
 
-        op_logger.info(f"Starting download: {' '.join(cmd)}")
-        download_success = await run_aria2c(cmd, msg, start_time, torrent_name)
-        
-        if not download_success:
-            await safe_edit_message(msg, "❌ Download failed or canceled")
-            return False
+        options = {
+            "dir": str(USER_DIR.resolve()),
+            "bt-tracker": ",".join(best_trackers or DEFAULT_TRACKERS),
+            "file-allocation": await run_fs(file_allocation_mode),
+        }
 
-        # Find and sort downloaded files
-        files = []
-        for file_path in USER_DIR.rglob("*"):
-            if (file_path.is_file() and 
-                file_path.stat().st_size > 1024 and
-                not file_path.suffix.lower() in ('.aria2', '.tmp', '.torrent')):
-                files.append(file_path)
-        
-        if not files:
-            await safe_edit_message(msg, "❌ No files found after download")
+        cacheable = not resuming
+        stream_files = []
+        if resuming:
+            # Re-add below rather than reattach to what the aria2 session restored, so the file
+            # selection and streaming batches are rebuilt; aria2 continues from its control files
+            await drop_aria2_download(job["gid"])
+            if job["file_count"]:
+                # Only fetch what has not been delivered before the restart
+                delivered = {index for index, part in done_parts if part == 0}
+                wanted = parse_selection(job["selected"]) or range(1, job["file_count"] + 1)
+                if all(i in delivered for i in wanted):
+                    return True
+
+        # Hold the content until the cache and the file selection are settled
+        hold = "pause-metadata" if download_link.startswith("magnet:?") else "pause"
+        gid = await add_aria2_download(download_link, {**options, hold: "true"})
+        journal_update(job_id, gid=gid)
+        if not infohash:
+            infohash = (await aria2_call("tell_status", gid, ["infoHash"])).get("infoHash")
+            if infohash and not resuming and await send_from_cache(msg, infohash):
+                await discard_aria2_download(gid, force=True)
+                return True
+
+        with phase_timer("metadata", stats):
+            gid = await wait_for_metadata(gid, msg, start_time, torrent_name)
+        if not gid:
+            await safe_edit_message(msg, "❌ Could not fetch torrent metadata")
             return False
+        journal_update(job_id, gid=gid)
+        if infohash and download_link.startswith("magnet:?"):
+            await run_fs(save_metadata, infohash, str(USER_DIR.resolve()))
 
-        # Sort files naturally
-        files.sort(key=lambda x: natural_sort_key(x.name))
+        aria2_files = await aria2_call("get_files", gid)
+        if resuming:
+            # No saved selection means the restart came before the file picker closed
+            wanted = set(parse_selection(job["selected"]) or auto_select_files(aria2_files))
+        else:
+            selected, auto_selected = await choose_files(msg, user_id, torrent_name, aria2_files)
+            cacheable = selected == auto_selected
+            wanted = set(selected)
+            journal_update(job_id, selected=",".join(map(str, selected)))
 
-        await safe_edit_message(msg, f"📁 Found {len(files)} files. Starting uploads...")
-        
-        for file_path in files:
-            filename = file_path.name
-            size = file_path.stat().st_size
+        # Fetch only what is still missing, in upload order, in batches that fit on the disk
+        delivered = {index for index, part in done_parts if part == 0}
+        stream_files = sorted(
+            (f for f in aria2_files if int(f["index"]) in wanted - delivered),
+            key=lambda f: natural_sort_key(os.path.basename(f["path"]))
+        )
+        size = sum(int(f["length"]) for f in stream_files)
+        journal_update(job_id, size=size)
+        budget = await run_fs(disk_budget)
+        if size > budget:
+            op_logger.info(
+                f"Streaming {torrent_name}: {len(stream_files)} files exceed "
+                f"the disk budget of {human_readable_size(budget)}"
+            )
+        batch = next_stream_batch(stream_files, budget, stats)
+        if len(batch) < len(aria2_files):
+            await aria2_call("change_option", gid, {"select-file": ",".join(f["index"] for f in batch)})
+        await aria2_call("unpause", gid)
+        stats["phase"] = "download"
+        op_logger.info(f"{'Resumed' if resuming else 'Started'} download {gid}: {torrent_name}")
+        if infohash and cacheable:
+            cache_begin(infohash, torrent_name)
+        stats["name"] = torrent_name
 
-            if size > MAX_SIZE:
-                await safe_edit_message(msg, f"⚠️ Splitting large file: {filename}")
-                file_parts = split_large_file(str(file_path))
-                file_path.unlink()  # Remove original file
-            else:
-                file_parts = [str(file_path)]
-
-            total_parts = len(file_parts)
-            for part_index, part in enumerate(file_parts, 1):
-                part_name = os.path.basename(part)
-                part_size = os.path.getsize(part)
-                
-                await safe_edit_message(
-                    msg,
-                    f"📤 **Uploading...**\n"
-                    f"📁 File: `{filename}`\n"
-                    f"🔸 Part: `{part_index}/{total_parts}`\n"
-                    f"📦 Size: `{human_readable_size(part_size)}`\n"
-                )
-                
-                mime, _ = mimetypes.guess_type(part)
-                mime = mime or "application/octet-stream"
-                
-                try:
-                    if mime.startswith("video"):
-                        thumbnail = extract_thumbnail(part)
-                        duration = get_duration(part)
-                        await msg.reply_video(
-                            video=part,
-                            caption=f"🎬 {filename}",
-                            supports_streaming=True,
-                            duration=duration,
-                            thumb=thumbnail,
-                            progress=create_upload_callback(msg, part_name)
-                        )
-                        if thumbnail and os.path.exists(thumbnail):
-                            os.remove(thumbnail)
-                    elif mime.startswith("audio"):
-                        duration = get_duration(part)
-                        await msg.reply_audio(
-                            audio=part,
-                            caption=f"🎵 {filename}",
-                            duration=duration,
-                            progress=create_upload_callback(msg, part_name)
-                        )
-                    elif mime.startswith("image"):
-                        await msg.reply_photo(
-                            photo=part,
-                            caption=f"🖼️ {filename}",
-                            progress=create_upload_callback(msg, part_name)
-                        )
+        torrent_files = []
+        files_changed = asyncio.Event()
+
+        recorded_count = job["file_count"] if job else None
+
+        def on_files(aria2_files):
+            nonlocal recorded_count
+            if recorded_count != len(aria2_files):
+                journal_update(job_id, file_count=len(aria2_files))
+                recorded_count = len(aria2_files)
+            torrent_files[:] = pick_uploadable_files(aria2_files)
+            files_changed.set()
+
+        def on_gid(new_gid):
+            journal_update(job_id, gid=new_gid)
+
+        uploader = OrderedUploader(msg, infohash, job_id, done_parts, stats, cacheable)
+        submitted = set()
+        while True:
+            download = asyncio.create_task(
+                run_aria2_download(gid, msg, start_time, torrent_name, on_files, on_gid, stats)
+            )
+            download.add_done_callback(lambda _: files_changed.set())
+            if not PIPELINED_UPLOADS:
+                await asyncio.wait([download])
+
+            # Submit each file as soon as it and every file before it (in natural order) is complete.
+            # With many small files, those are held back and sent as archives once the download ends.
+            packing = None
+            held = []
+            while True:
+                if packing is None and torrent_files:
+                    small = sum(entry[3] <= PACK_MAX_FILE_SIZE for entry in torrent_files)
+                    packing = PACK_SMALL_FILES and small >= PACK_MIN_FILES
+                pending = [entry for entry in torrent_files if entry[0] not in submitted]
+                if pending and pending[0][1]:
+                    file_path, _, file_index, length = pending[0]
+                    if packing and length <= PACK_MAX_FILE_SIZE:
+                        held.append((file_path, file_index))
                     else:
-                        await msg.reply_document(
-                            document=part,
-                            caption=f"📦 {filename}",
-                            progress=create_upload_callback(msg, part_name)
-                        )
-                except Exception as e:
-                    op_logger.error(f"Upload failed for {part}: {str(e)}")
-                    await safe_edit_message(msg, f"❌ Upload failed for {part_name}: {str(e)}")
-                finally:
-                    if os.path.exists(part):
-                        os.remove(part)
+                        await uploader.submit(file_path, file_index)
+                    submitted.add(file_path)
+                    continue
+                if download.done():
+                    break
+                files_changed.clear()
+                await files_changed.wait()
+            if held:
+                await uploader.submit_archive(held, sanitize_filename(torrent_name), USER_DIR)
+
+            if not download.result() or not stream_files:
+                break
+
+            # Streaming: let the uploader free the disk before fetching the next batch
+            await uploader.drain()
+            batch = next_stream_batch(stream_files, await run_fs(disk_budget), stats)
+            metric_inc("stream_batches_total")
+            metadata = download_link
+            if metadata.startswith("magnet:?"):
+                # aria2 saved the resolved metadata next to the files (--bt-save-metadata)
+                metadata = str(USER_DIR.resolve() / f"{infohash}.torrent")
+            gid = await add_aria2_download(metadata, {**options, "select-file": ",".join(f["index"] for f in batch)})
+            journal_update(job_id, gid=gid)
+            start_time = time.time()
+        await uploader.close()
+
+        if not download.result():
+            await safe_edit_message(msg, "❌ Download failed or canceled")
+            return False
+
+        if not submitted and not done_parts:
+            await safe_edit_message(msg, "❌ No files found after download")
+            return False
+
+        if infohash and cacheable and not uploader.failed:
+            cache_complete(infohash)
         return True
+    except asyncio.CancelledError:
+        # Shutting down: keep the files and aria2 control file so the job can resume
+        interrupted = True
+        raise
     except Exception as e:
         op_logger.error(f"Processing error: {str(e)}")
         await safe_edit_message(msg, f"❌ Processing error: {str(e)}")
         return False
     finally:
-        clean_directory(str(USER_DIR))
+        job_stats.pop(stats_key, None)
+        if uploader:
+            await uploader.abort()
+        if download and not download.done():
+            download.cancel()
+            await asyncio.wait([download])
+        release_infohash(claimed)
+        if not interrupted:
+            await run_fs(clean_directory, str(USER_DIR))
 
-def create_upload_callback(msg, part_name):
-    last_reported = 0
+def create_upload_callback(msg, part_name, stats=None):
+    last_percent = -1
+    last_current = 0
     
     async def callback(current, total):
-        nonlocal last_reported
+        nonlocal last_percent, last_current
         if total <= 0:
             return
+        record_upload(stats, current - last_current)
+        last_current = current
             
         percent = math.floor(current * 100 / total)
-        current_time = time.time()
-        
-        if percent == 100 or current_time - last_reported > 5:
+        if percent != last_percent:
             text = (
                 f"📤 **Uploading...**\n"
                 f"📁 File: `{part_name}`\n"
                 f"📊 Progress: {human_readable_size(current)} / {human_readable_size(total)}\n"
                 f"🔸 {progress_bar(percent)} 🔸\n"
             )
-            await safe_edit_message(msg, text)
-            last_reported = current_time
+            post_progress(msg, text)
+            last_percent = percent
     
     return callback
 
-async def process_user_queue(user_id):
-    while user_queues.get(user_id) and user_queues[user_id]:
-        link = user_queues[user_id][0]
+async def process_job(user_id, job_id, link):
+    msg = None
+    try:
+        job = journal_get(job_id)
+        resuming = bool(job and job["dir"])
+        journal_update(job_id, state="running")
+        msg = await with_flood_retry(
+            bot.send_message, user_id, "🔄 Resuming after restart..." if resuming else "🔄 Processing started...",
+            source="reply"
+        )
+        users.touch(user_id, force=True).status_message_id = msg.id
+        success = await process_torrent(user_id, link, msg, job_id)
+        journal_update(job_id, state="done" if success else "failed")
+
+        if not success:
+            await safe_edit_message(msg, "❌ Processing failed")
+        else:
+            try:
+                await msg.delete()
+            except:
+                pass
+    except Exception as e:
+        op_logger.error(f"Queue processing error: {str(e)}")
+        journal_update(job_id, state="failed")
+        if msg:
+            await safe_edit_message(msg, f"❌ Error: {str(e)}")
+    finally:
+        state = users.touch(user_id, force=True)
+        state.active_tasks = max(0, state.active_tasks - 1)
+        if msg:
+            forget_progress(msg)
+        if state.idle():
+            state.status_message_id = None
+        scheduler_wakeup.set()
+
+async def check_admission():
+    """Decide whether the node can take one more download right now."""
+    try:
+        free = psutil.disk_usage(DOWNLOAD_DIR).free - await run_fs(disk_reserved)
+        if free < MIN_FREE_DISK:
+            return False, f"low disk space ({human_readable_size(free)} free)"
+    except Exception as e:
+        op_logger.error(f"Disk usage check failed: {str(e)}")
+
+    if MAX_TOTAL_BANDWIDTH and running_jobs:
         try:
-            msg = await bot.send_message(user_id, "🔄 Processing started...")
-            user_messages[user_id] = msg
-            active_downloads[user_id] = msg.id
-            success = await process_torrent(user_id, link, msg)
-            
-            if not success:
-                await safe_edit_message(msg, "❌ Processing failed")
-            else:
-                try:
-                    await msg.delete()
-                except:
-                    pass
+            stat = await aria2_call("get_global_stat")
+            speed = int(stat.get("downloadSpeed", 0))
+            if speed >= MAX_TOTAL_BANDWIDTH * 0.9:
+                return False, f"bandwidth saturated ({human_readable_size(speed)}/s)"
         except Exception as e:
-            op_logger.error(f"Queue processing error: {str(e)}")
-            if user_id in user_messages:
-                await safe_edit_message(user_messages[user_id], f"❌ Error: {str(e)}")
-        finally:
-            if user_queues.get(user_id):
-                user_queues[user_id].popleft()
-                if not user_queues[user_id]:
-                    del user_queues[user_id]
-                    if user_id in user_messages:
-                        del user_messages[user_id]
-                    if user_id in active_downloads:
-                        del active_downloads[user_id]
-        await asyncio.sleep(1)
-    if user_id in user_active_tasks:
-        user_active_tasks[user_id] -= 1
-        if user_active_tasks[user_id] <= 0:
-            del user_active_tasks[user_id]
+            op_logger.error(f"Bandwidth check failed: {str(e)}")
+    return True, None
+
+def may_start(user_id):
+    state = users.peek(user_id)
+    return bool(state and state.queue and state.active_tasks < MAX_CONCURRENT_DOWNLOADS)
+
+def job_rank(job_id, sizes):
+    return sizes.get(job_id, UNKNOWN_JOB_SIZE)
+
+def next_fair_user():
+    """Pick the next user in round-robin order that may start another job."""
+    for _ in range(len(user_rotation)):
+        user_id = user_rotation[0]
+        user_rotation.rotate(-1)
+        if may_start(user_id):
+            return user_id
+    return None
+
+def next_shortest_user(sizes):
+    """Pick the user whose smallest queued job is the smallest overall; ties go round-robin."""
+    candidates = [user_id for user_id in user_rotation if may_start(user_id)]
+    if not candidates:
+        return None
+    user_id = min(candidates, key=lambda u: min(job_rank(job_id, sizes) for job_id, _ in users.peek(u).queue))
+    user_rotation.remove(user_id)
+    user_rotation.append(user_id)
+    return user_id
+
+def take_shortest(queue, sizes):
+    """Remove and return the smallest job in a user's queue, the oldest of equals."""
+    entry = min(queue, key=lambda e: job_rank(e[0], sizes))
+    queue.remove(entry)
+    return entry
+
+def paused_downloads():
+    return sum(1 for stats in list(job_stats.values()) if stats["paused_at"])
+
+def download_remaining(stats):
+    return stats["total"] - stats["downloaded"] + stats["backlog"]
+
+def plan_preemption(downloads, slots, waiting):
+    """Choose which downloads to pause so that at most `slots` run.
+
+    `waiting` is the size of the smallest job that could start, or None. The download
+    with the most left is paused first; the waiting job gets a slot only if it is smaller.
+    """
+    now = time.time()
+    victims = sorted(
+        (s for s in downloads
+         if download_remaining(s) >= PREEMPT_MIN_SIZE
+         and s["paused_seconds"] + (now - s["paused_at"] if s["paused_at"] else 0) < MAX_PREEMPT_TIME),
+        key=download_remaining, reverse=True
+    )
+    pause = victims[:max(0, len(downloads) - slots)]
+    rest = victims[len(pause):]
+    if (waiting is not None and rest and len(pause) < MAX_PAUSED_DOWNLOADS
+            and len(downloads) - len(pause) >= slots and download_remaining(rest[0]) > waiting):
+        pause.append(rest[0])
+    return pause
+
+async def preempt_downloads():
+    """Pause large downloads while smaller jobs wait, and resume them once they can run again."""
+    # Not the phase: with pipelined uploads it reads "upload" while the torrent is still downloading
+    downloads = [s for s in list(job_stats.values()) if s["downloading"]]
+    # Jobs fetching metadata or uploading keep their slot
+    slots = MAX_GLOBAL_DOWNLOADS - (len(running_jobs) - len(downloads))
+    if ROLE == "worker":
+        waiting = journal_smallest_claimable(WORKER_ID)
+    else:
+        sizes = journal_queued_sizes()
+        waiting = min((job_rank(job_id, sizes) for user_id in user_rotation if may_start(user_id)
+                       for job_id, _ in users.peek(user_id).queue), default=None)
+    pause = {id(stats) for stats in plan_preemption(downloads, slots, waiting)}
+
+    for stats in downloads:
+        try:
+            if id(stats) in pause and not stats["paused_at"]:
+                await aria2_call("pause", stats["gid"])
+                stats["paused_at"] = time.time()
+                metric_inc("preemptions_total")
+                op_logger.info(f"Paused {stats['name']} with {human_readable_size(download_remaining(stats))} left")
+            elif id(stats) not in pause and stats["paused_at"]:
+                await aria2_call("unpause", stats["gid"])
+                stats["paused_seconds"] += time.time() - stats["paused_at"]
+                stats["paused_at"] = None
+                op_logger.info(f"Resumed {stats['name']}")
+        except Exception as e:
+            op_logger.error(f"Could not {'pause' if id(stats) in pause else 'resume'} {stats['gid']}: {str(e)}")
+
+async def admit_jobs():
+    sizes = journal_queued_sizes()
+    while len(running_jobs) - paused_downloads() < MAX_GLOBAL_DOWNLOADS:
+        if ROLE == "worker":
+            if not journal_claimable(WORKER_ID):
+                return
+        else:
+            user_id = next_shortest_user(sizes) if SCHEDULING == "sjf" else next_fair_user()
+            if user_id is None:
+                return
+        admitted, reason = await check_admission()
+        if not admitted:
+            op_logger.info(f"Admission paused: {reason}")
+            return
+
+        if ROLE == "worker":
+            claimed = journal_claim(WORKER_ID)
+            if not claimed:
+                return
+            job_id, user_id, link = claimed
+        else:
+            job_id, link = take_shortest(users.peek(user_id).queue, sizes)
+            if not users.peek(user_id).queue:
+                user_rotation.remove(user_id)
+        users.touch(user_id, force=True).active_tasks += 1
+
+        task = asyncio.create_task(process_job(user_id, job_id, link))
+        running_jobs.add(task)
+        task.add_done_callback(running_jobs.discard)
+
+        # New jobs need time to ramp up before the bandwidth check is meaningful
+        if MAX_TOTAL_BANDWIDTH:
+            return
+
+async def download_scheduler():
+    while True:
+        scheduler_wakeup.clear()
+        try:
+            await preempt_downloads()
+            await admit_jobs()
+        except Exception as e:
+            op_logger.error(f"Scheduler error: {str(e)}")
+        try:
+            await asyncio.wait_for(scheduler_wakeup.wait(), SCHEDULER_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+@bot.on_callback_query(filters.regex(r"^pick:"))
+async def file_picker_handler(client, query):
+    _, token, action, *args = query.data.split(":")
+    picker = file_pickers.get(token)
+    if not picker:
+        await query.answer("This selection has expired.")
+        return
+    if query.from_user.id != picker["user_id"]:
+        await query.answer("This is not your torrent.")
+        return
+
+    all_indices = {f["index"] for f in picker["files"]}
+    if action == "t":
+        picker["selected"] ^= {int(args[0])} & all_indices
+    elif action == "p":
+        picker["page"] = int(args[0])
+    elif action == "a":
+        picker["selected"] = set(all_indices)
+    elif action == "n":
+        picker["selected"] = set()
+    elif action == "go":
+        if not picker["selected"]:
+            await query.answer("Select at least one file.")
+            return
+        picker["done"].set()
+        await query.answer("Starting download")
+        return
+    await query.answer()
+    await show_file_picker(query.message, token)
 
 @bot.on_message((filters.private | filters.group) & (filters.text | filters.document))
 async def message_handler(client: Client, message: Message):
@@ -528,43 +2685,58 @@ async def message_handler(client: Client, message: Message):
     is_torrent_url = text and re.match(TORRENT_REGEX, text, re.IGNORECASE)
 
     if not (is_magnet or is_torrent_url or is_torrent_file):
-        await message.reply("❌ Please send a valid magnet link, .torrent URL, or .torrent file.")
+        await with_flood_retry(message.reply, "❌ Please send a valid magnet link, .torrent URL, or .torrent file.", source="reply")
         return
 
-    # Check if user has an active task
-    if user_id in user_active_tasks and user_active_tasks[user_id] > 0:
-        await message.reply("❌ You already have an active task. Please wait until it completes.")
+    state = None
+    if ROLE == "frontend":
+        queued = int(journal_queue_depth().get(str(user_id), 0))
+    else:
+        state = users.touch(user_id)
+        if state is None:
+            await with_flood_retry(message.reply, "❌ The bot is at capacity right now. Please try again later.", source="reply")
+            return
+        queued = len(state.queue)
+    if queued >= MAX_QUEUED_PER_USER:
+        await with_flood_retry(
+            message.reply, f"❌ You already have {queued} links queued. Please wait until they complete.", source="reply"
+        )
         return
 
     link = None
     if is_torrent_file:
         try:
-            file_path = await message.download(os.path.join(DOWNLOAD_DIR, f"user_{user_id}_{int(time.time())}.torrent"))
+            file_path = await message.download(os.path.join(TORRENT_DIR, f"user_{user_id}_{int(time.time())}.torrent"))
             link = file_path
         except Exception as e:
             op_logger.error(f"Error downloading torrent file: {str(e)}")
-            await message.reply(f"❌ Failed to download .torrent file: {str(e)}")
+            await with_flood_retry(message.reply, f"❌ Failed to download .torrent file: {str(e)}", source="reply")
             return
     elif is_magnet or is_torrent_url:
         link = text
+    size = await run_fs(estimate_job_size, link)
 
-    if user_id not in user_queues:
-        user_queues[user_id] = deque()
-    if user_id not in user_active_tasks:
-        user_active_tasks[user_id] = 0
+    if ROLE == "frontend":
+        # A worker picks the job up from the journal on its next scheduler pass
+        journal_add(user_id, link, size)
+        await with_flood_retry(message.reply, f"⏳ Added to queue (position {queued + 1})", source="reply")
+        return
 
-    user_queues[user_id].append(link)
-    user_active_tasks[user_id] += 1
-    asyncio.create_task(process_user_queue(user_id))
+    state = users.touch(user_id, force=True)  # The download above may have let it expire
+    if not state.queue:
+        user_rotation.append(user_id)
+    state.queue.append((journal_add(user_id, link, size), link))
+    if state.active_tasks or len(running_jobs) - paused_downloads() >= MAX_GLOBAL_DOWNLOADS:
+        await with_flood_retry(message.reply, f"⏳ Added to queue (position {len(state.queue)})", source="reply")
+    scheduler_wakeup.set()
 
 async def cleanup_scheduler():
     while True:
         try:
-            download_dir = Path(DOWNLOAD_DIR)
-            if download_dir.exists():
-                for entry in download_dir.iterdir():
-                    if entry.is_dir() and time.time() - entry.stat().st_mtime > 3600:
-                        clean_directory(str(entry))
+            for directory, max_age in {DOWNLOAD_DIR: 3600, TORRENT_DIR: 3600, METADATA_DIR: CACHE_TTL}.items():
+                stale = await run_fs(find_stale_entries, directory, max_age, journal_active_paths())
+                for path in stale:
+                    await run_fs(remove_path, path)
         except Exception as e:
             op_logger.error(f"Cleanup error: {str(e)}")
         await asyncio.sleep(3600)
@@ -573,8 +2745,23 @@ if __name__ == "__main__":
     try:
         op_logger.info("🚀 Starting Torrent Downloader Bot...")
         os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        os.makedirs(TORRENT_DIR, exist_ok=True)
         loop = asyncio.get_event_loop()
+        if ROLE == "all":
+            resume_jobs()
+        elif ROLE == "worker":
+            op_logger.info(f"Running as worker {WORKER_ID}")
+            journal_prune()
+            journal_release(WORKER_ID)
+        if ROLE != "frontend":
+            if not start_aria2_daemon():
+                op_logger.error("Continuing without aria2; downloads will retry the daemon on demand")
+            loop.create_task(download_scheduler())
+            loop.create_task(tracker_scheduler())
+            loop.create_task(aria2_tuner())
         loop.create_task(cleanup_scheduler())
+        loop.create_task(progress_updater())
+        loop.create_task(loop_lag_monitor())
         bot.run()
     except Exception as e:
         op_logger.error(f"Bot startup failed: {str(e)}")
\ No newline at end of file